@@ -12,6 +12,7 @@ sys.path.extend(os.path.abspath(os.path.join(os.getcwd(), d))
                 for d in ['pddlstream', 'ss-pybullet'])
 
 from itertools import product
+from multiprocessing import cpu_count
 
 from pybullet_tools.utils import wait_for_user, elapsed_time, multiply, \
     invert, get_link_pose, has_gui, write_json, get_body_name, get_link_name, \
@@ -22,7 +23,8 @@ from src.utils import get_block_path, BLOCK_SIZES, BLOCK_COLORS, GRASP_TYPES, TO
 from src.world import World
 from src.stream import get_stable_gen, get_grasp_gen, Z_EPSILON
 from src.streams.pick import get_pick_gen_fn
-from src.database import DATABASE_DIRECTORY, PLACE_IR_FILENAME, get_surface_reference_pose, get_place_path
+from src.database import DATABASE_DIRECTORY, PLACE_IR_FILENAME, get_surface_reference_pose, get_place_path, \
+    start_shard, append_shard_entry, compact_database, collect_parallel
 
 # TODO: condition on the object type (but allow a default object)
 # TODO: generalize to any manipulation with a movable entity
@@ -48,10 +50,12 @@ def collect_place(world, object_name, surface_name, grasp_type, args):
     print('Robot name: {} | Object name: {} | Surface name: {} | Grasp type: {} | Filename: {}'.format(
         robot_name, object_name, surface_name, grasp_type, path))
 
+    num_existing, shard_path = start_shard(path, date)
+
     entries = []
     start_time = time.time()
     failures = 0
-    while (len(entries) < args.num_samples) and \
+    while (num_existing + len(entries) < args.num_samples) and \
             (elapsed_time(start_time) < args.max_time): #and (failures <= max_failures):
         (rel_pose,) = next(stable_gen)
         if rel_pose is None:
@@ -61,7 +65,7 @@ def collect_place(world, object_name, surface_name, grasp_type, args):
             result = next(ik_ir_gen(object_name, rel_pose, grasp), None)
         if result is None:
             print('Failure! | {} / {} [{:.3f}]'.format(
-                len(entries), args.num_samples, elapsed_time(start_time)))
+                num_existing + len(entries), args.num_samples, elapsed_time(start_time)))
             failures += 1
             continue
         # TODO: ensure an arm motion exists
@@ -72,19 +76,18 @@ def collect_place(world, object_name, surface_name, grasp_type, args):
         base_pose = get_link_pose(world.robot, world.base_link)
         object_pose = rel_pose.get_world_from_body()
         tool_pose = multiply(object_pose, invert(grasp.grasp_pose))
-        entries.append({
+        entry = {
             'tool_from_base': multiply(invert(tool_pose), base_pose),
             'surface_from_object': multiply(invert(surface_pose), object_pose),
             'base_from_object': multiply(invert(base_pose), object_pose),
-        })
+        }
+        append_shard_entry(shard_path, entry)
+        entries.append(entry)
         print('Success! | {} / {} [{:.3f}]'.format(
-            len(entries), args.num_samples, elapsed_time(start_time)))
+            num_existing + len(entries), args.num_samples, elapsed_time(start_time)))
         if has_gui():
             wait_for_user()
     #visualize_database(tool_from_base_list)
-    if not entries:
-        safe_remove(path)
-        return None
 
     # Assuming the kitchen is fixed but the objects might be open world
     data = {
@@ -96,17 +99,33 @@ def collect_place(world, object_name, surface_name, grasp_type, args):
         'surface_name': surface_name,
         'object_name': object_name,
         'grasp_type': grasp_type,
-        'entries': entries,
         'failures': failures,
-        'successes': len(entries),
     }
-
-    write_json(path, data)
+    data = compact_database(path, data)
+    if not data['entries']:
+        return None
     print('Saved', path)
     return data
 
 ################################################################################
 
+def create_world(args, use_gui=False):
+    world = World(use_gui=use_gui, robot_name=args.robot)
+    #dump_body(world.robot)
+    for joint in world.kitchen_joints:
+        world.open_door(joint) # open_door | close_door
+    world.open_gripper()
+    # TODO: sample from set of objects?
+    object_name = '{}_{}_block{}'.format(BLOCK_SIZES[-1], BLOCK_COLORS[0], 0)
+    world.add_body(object_name)
+    # TODO: could constrain Eve to be within a torso cone
+    return world, object_name
+
+def collect_combination(state, combination, args):
+    world, object_name = state
+    surface_name, grasp_type = combination
+    return collect_place(world, object_name, surface_name, grasp_type, args)
+
 def main():
     parser = argparse.ArgumentParser()
     #parser.add_argument('-attempts', default=100, type=int,
@@ -117,6 +136,8 @@ def main():
     #                    help='Specifies the type of grasp.')
     #parser.add_argument('-problem', default='test_block',
     #                    help='The name of the problem to solve.')
+    parser.add_argument('-jobs', default=1, type=int,
+                        help='The number of worker processes (0 uses all {} cores).'.format(cpu_count()))
     parser.add_argument('-max_time', default=10*60, type=float,
                         help='The maximum runtime')
     parser.add_argument('-num_samples', default=1000, type=int,
@@ -130,16 +151,7 @@ def main():
     parser.add_argument('-visualize', action='store_true',
                         help='When enabled, visualizes planning rather than the world (for debugging).')
     args = parser.parse_args()
-
-    world = World(use_gui=args.visualize, robot_name=args.robot)
-    #dump_body(world.robot)
-    for joint in world.kitchen_joints:
-        world.open_door(joint) # open_door | close_door
-    world.open_gripper()
-    # TODO: sample from set of objects?
-    object_name = '{}_{}_block{}'.format(BLOCK_SIZES[-1], BLOCK_COLORS[0], 0)
-    world.add_body(object_name)
-    # TODO: could constrain Eve to be within a torso cone
+    assert (args.jobs == 1) or not args.visualize
 
     grasp_colors = {
         TOP_GRASP: RED,
@@ -155,8 +167,12 @@ def main():
         if surface_name in (OPEN_SURFACES + CABINETS):
             combinations.append((surface_name, SIDE_GRASP))
 
-    # TODO: parallelize
     print('Combinations:', combinations)
+    if args.jobs != 1:
+        collect_parallel(create_world, collect_combination, combinations, args)
+        return
+
+    world, object_name = create_world(args, use_gui=args.visualize)
     wait_for_user('Start?')
     for surface_name, grasp_type in combinations:
         #draw_picks(world, object_name, surface_name, grasp_type, color=grasp_colors[grasp_type])
@@ -165,4 +181,3 @@ def main():
 
 if __name__ == '__main__':
     main()
-
@@ -10,6 +10,8 @@ import time
 sys.path.extend(os.path.abspath(os.path.join(os.getcwd(), d))
                 for d in ['pddlstream', 'ss-pybullet'])
 
+from multiprocessing import cpu_count
+
 from pybullet_tools.pr2_primitives import Conf
 from pybullet_tools.utils import wait_for_user, elapsed_time, multiply, \
     invert, get_link_pose, has_gui, write_json, get_body_name, get_link_name, \
@@ -18,7 +20,8 @@ from src.utils import CABINET_JOINTS, DRAWER_JOINTS, KNOBS, ZED_LEFT_JOINTS
 from src.world import World
 from src.streams.press import get_press_gen_fn
 from src.streams.pull import get_pull_gen_fn
-from src.database import get_joint_reference_pose, get_pull_path, is_press
+from src.database import get_joint_reference_pose, get_pull_path, is_press, \
+    start_shard, append_shard_entry, compact_database, collect_parallel
 
 # TODO: generalize to any manipulation with a fixed entity
 
@@ -40,10 +43,12 @@ def collect_pull(world, joint_name, args):
     print(SEPARATOR)
     print('Robot name {} | Joint name: {} | Filename: {}'.format(robot_name, joint_name, path))
 
+    num_existing, shard_path = start_shard(path, date)
+
     entries = []
     failures = 0
     start_time = time.time()
-    while (len(entries) < args.num_samples) and \
+    while (num_existing + len(entries) < args.num_samples) and \
             (elapsed_time(start_time) < args.max_time):
         if is_press(joint_name):
             result = next(press_gen(joint_name), None)
@@ -51,7 +56,7 @@ def collect_pull(world, joint_name, args):
             result = next(pull_gen(joint_name, open_conf, closed_conf), None) # Open to closed
         if result is None:
             print('Failure! | {} / {} [{:.3f}]'.format(
-                len(entries), args.num_samples, elapsed_time(start_time)))
+                num_existing + len(entries), args.num_samples, elapsed_time(start_time)))
             failures += 1
             continue
         if not is_press(joint_name):
@@ -63,16 +68,15 @@ def collect_pull(world, joint_name, args):
         #next(at.commands[2].iterate(None, None))
         base_pose = get_link_pose(world.robot, world.base_link)
         #handle_pose = get_link_pose(world.robot, base_link)
-        entries.append({
+        entry = {
             'joint_from_base': multiply(invert(joint_pose), base_pose),
-        })
+        }
+        append_shard_entry(shard_path, entry)
+        entries.append(entry)
         print('Success! | {} / {} [{:.3f}]'.format(
-            len(entries), args.num_samples, elapsed_time(start_time)))
+            num_existing + len(entries), args.num_samples, elapsed_time(start_time)))
         if has_gui():
             wait_for_user()
-    if not entries:
-        safe_remove(path)
-        return None
     #visualize_database(joint_from_base_list)
 
     # Assuming the kitchen is fixed but the objects might be open world
@@ -84,9 +88,7 @@ def collect_pull(world, joint_name, args):
         'tool_link': get_link_name(world.robot, world.tool_link),
         'kitchen_name': get_body_name(world.kitchen),
         'joint_name': joint_name,
-        'entries': entries,
         'failures': failures,
-        'successes': len(entries),
     }
     if not is_press(joint_name):
         data.update({
@@ -94,18 +96,27 @@ def collect_pull(world, joint_name, args):
             'closed_conf': closed_conf.values,
         })
 
-    write_json(path, data)
+    data = compact_database(path, data)
+    if not data['entries']:
+        return None
     print('Saved', path)
     return data
 
 ################################################################################
 
+def create_world(args, use_gui=False):
+    world = World(use_gui=use_gui)
+    world.open_gripper()
+    return world
+
 def main():
     parser = argparse.ArgumentParser()
     #parser.add_argument('-attempts', default=100, type=int,
     #                    help='The number of attempts')
     parser.add_argument('-cfree', action='store_true',
                         help='When enabled, disables collision checking (for debugging).')
+    parser.add_argument('-jobs', default=1, type=int,
+                        help='The number of worker processes (0 uses all {} cores).'.format(cpu_count()))
     parser.add_argument('-max_time', default=10 * 60, type=float,
                         help='The maximum runtime')
     parser.add_argument('-num_samples', default=1000, type=int,
@@ -117,15 +128,18 @@ def main():
     parser.add_argument('-visualize', action='store_true',
                         help='When enabled, visualizes planning rather than the world (for debugging).')
     args = parser.parse_args()
+    assert (args.jobs == 1) or not args.visualize
     # TODO: could record the full trajectories here
 
-    world = World(use_gui=args.visualize)
-    world.open_gripper()
-
     #joint_names = DRAWER_JOINTS + CABINET_JOINTS
     joint_names = ZED_LEFT_JOINTS
     print('Joints:', joint_names)
     print('Knobs:', KNOBS)
+    if args.jobs != 1:
+        collect_parallel(create_world, collect_pull, joint_names + KNOBS, args)
+        return
+
+    world = create_world(args, use_gui=args.visualize)
     wait_for_user('Start?')
     for joint_name in joint_names:
         collect_pull(world, joint_name, args)
@@ -136,4 +150,3 @@ def main():
 
 if __name__ == '__main__':
     main()
-
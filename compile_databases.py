@@ -0,0 +1,45 @@
+#!/usr/bin/env python2
+
+from __future__ import print_function
+
+import argparse
+import glob
+import os
+import sys
+import time
+
+sys.path.extend(os.path.abspath(os.path.join(os.getcwd(), d))
+                for d in ['pddlstream', 'ss-pybullet'])
+
+from pybullet_tools.utils import elapsed_time
+from src.database import DATABASE_DIRECTORY, compile_database, get_compiled_path, is_compiled, compile_rasters, \
+    get_raster_path, is_rasterized
+
+# Converts the JSON inverse-reachability databases into memory-mappable arrays
+# and rasterizes their reachability polygons into occupancy grids
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-force', action='store_true',
+                        help='Recompiles databases that are already up to date.')
+    parser.add_argument('-directory', default=DATABASE_DIRECTORY,
+                        help='The directory of databases to compile.')
+    args = parser.parse_args()
+
+    paths = sorted(glob.glob(os.path.join(args.directory, '*.json')))
+    print('Databases:', len(paths))
+    for path in paths:
+        if not args.force and is_compiled(path) and is_rasterized(path):
+            print('Skipping', path)
+            continue
+        start_time = time.time()
+        array = compile_database(path)
+        print('Compiled {} entries into {} [{:.3f}]'.format(
+            len(array), get_compiled_path(path), elapsed_time(start_time)))
+        start_time = time.time()
+        grids = compile_rasters(path, array=array)
+        print('Rasterized {} grids into {} [{:.3f}]'.format(
+            len(grids), get_raster_path(path), elapsed_time(start_time)))
+
+if __name__ == '__main__':
+    main()
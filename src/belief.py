@@ -14,8 +14,12 @@ from examples.discrete_belief.dist import UniformDist, DeltaDist
 from pybullet_tools.utils import BodySaver, joint_from_name, LockRenderer, spaced_colors, WorldSaver, \
     pairwise_collision, elapsed_time, randomize, remove_handles, wait_for_duration, wait_for_user, \
     get_joint_positions, get_joint_name, get_joint_position, GREEN
+from src.collisions import CollisionTable, MAX_JOINT_ATTEMPTS
 from src.command import State, TIN_OBJECTS
-from src.inference import NUM_PARTICLES, PoseDist
+from src.raycache import get_ray_cache
+from src.inference import NUM_PARTICLES, UPDATE_WORKERS, PoseDist, update_occluded_dists, get_observable, \
+    get_detectables
+from src.workers import get_world_pool
 from src.observe import fix_detections, relative_detections, ELSEWHERE
 from src.stream import get_stable_gen
 from src.utils import create_relative_pose, RelPose, FConf, are_confs_close, type_from_name
@@ -41,6 +45,7 @@ from src.utils import create_relative_pose, RelPose, FConf, are_confs_close, typ
 
 MIN_GRASP_WIDTH = 0.005
 REPAIR_DETECTIONS = True
+SKIP_UNOBSERVABLE = True # Carries forward the beliefs of objects that could not have been seen
 STOCHASTIC_PLACE = False
 
 ################################################################################
@@ -62,6 +67,7 @@ class Belief(object):
         self.color_from_name = dict(zip(self.objects, colors))
         self.observations = []
         self.handles = []
+        self.collision_table = CollisionTable(world)
 
         # TODO: store state history
         self.base_conf = None
@@ -150,31 +156,55 @@ class Belief(object):
                     detections = fix_detections(self, detections) # TODO: skip if in sim
                 detections = relative_detections(self, detections)
                 order = [name for name in detections]  # Detected
-                order.extend(set(self.pose_dists) - set(order))  # Not detected
+                order.extend(sorted(set(self.pose_dists) - set(order)))  # Not detected
+                pool = get_world_pool(self.world, processes=UPDATE_WORKERS) if UPDATE_WORKERS else None
+                occluded = []
                 for name in order:
-                    self.pose_dists[name] = self.pose_dists[name].update(
-                        self, detections, n_samples=n_samples)
+                    if self.pose_dists[name].is_occlusion_independent(detections):
+                        self.pose_dists[name] = self.pose_dists[name].update(
+                            self, detections, n_samples=n_samples, pool=pool)
+                    else:
+                        occluded.append(name)
+                # Ray traces the remaining objects together once the detected objects are placed
+                # The detectable particles are computed once for both get_observable and update_occluded_dists
+                detectables = get_detectables(self, occluded)
+                observable = get_observable(self, occluded, detectables=detectables) \
+                    if (SKIP_UNOBSERVABLE and occluded) else occluded
+                if observable:
+                    self.pose_dists.update(update_occluded_dists(
+                        self, observable, detections, n_samples=n_samples, pool=pool, detectables=detectables))
         self.update_state()
-        print('Update time: {:.3f} sec for {} objects and {} samples'.format(
-            elapsed_time(start_time), len(order), n_samples))
+        print('Update time: {:.3f} sec for {} objects ({} skipped) and {} samples | {}'.format(
+            elapsed_time(start_time), len(order), len(occluded) - len(observable), n_samples,
+            get_ray_cache(self.world)))
         return self
 
-    def sample(self, discrete=True):
-        # TODO: timeout if unable to find
-        while True:
+    def sample(self, discrete=True, max_attempts=MAX_JOINT_ATTEMPTS):
+        # Returns None if unable to find a collision-free sample
+        if discrete:
+            return self.collision_table.sample(self.pose_dists, max_attempts=max_attempts)
+        for _ in range(max_attempts):
             poses = {}
             for name, pose_dist in randomize(self.pose_dists.items()):
                 body = self.world.get_body(name)
-                pose = pose_dist.sample_discrete() if discrete else pose_dist.sample()
+                pose = pose_dist.sample()
+                if pose is None:
+                    break
                 pose.assign()
                 if any(pairwise_collision(body, self.world.get_body(other)) for other in poses):
                     break
                 poses[name] = pose
             else:
                 return poses
+        return None
 
     def sample_state(self, **kwargs):
         pose_from_name = self.sample(**kwargs)
+        if pose_from_name is None:
+            print('Warning! Unable to sample a collision-free state')
+            pose_from_name = {name: pose_dist.sample_discrete() for name, pose_dist in self.pose_dists.items()}
+            for pose in pose_from_name.values():
+                pose.assign()
         world_saver = WorldSaver()
         attachments = []
         for pose in pose_from_name.values():
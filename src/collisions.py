@@ -0,0 +1,65 @@
+import numpy as np
+
+from pybullet_tools.utils import pairwise_collision, get_configuration, randomize
+from src.raycache import discretize
+
+# Joint samples of object poses from independent (per-object) particle beliefs
+# Pairwise collisions between particles of different objects are evaluated lazily and memoized
+
+MAX_JOINT_ATTEMPTS = 100 # Restarts before giving up on a collision-free joint sample
+MAX_TABLE_ENTRIES = 100000
+
+class CollisionTable(object):
+    def __init__(self, world, max_entries=MAX_TABLE_ENTRIES):
+        self.world = world
+        self.max_entries = max_entries
+        self.kitchen_key = None
+        self.collisions = {} # Keyed by pairs of (name, RelPose)
+        self.hits = 0
+        self.misses = 0
+    def update_kitchen(self):
+        # Particles are relative to kitchen links, so collisions change when the doors and drawers move
+        kitchen_key = discretize(get_configuration(self.world.kitchen))
+        if (kitchen_key != self.kitchen_key) or (self.max_entries <= len(self.collisions)):
+            self.collisions.clear()
+        self.kitchen_key = kitchen_key
+    def test(self, name1, pose1, name2, pose2):
+        key = tuple(sorted([(name1, pose1), (name2, pose2)], key=lambda pair: pair[0]))
+        if key in self.collisions:
+            self.hits += 1
+        else:
+            self.misses += 1
+            pose1.assign()
+            pose2.assign()
+            self.collisions[key] = pairwise_collision(self.world.get_body(name1), self.world.get_body(name2))
+        return self.collisions[key]
+    def sample_pose(self, name, pose_dist, placed):
+        # Samples a particle of name that doesn't collide with the placed (name, pose) pairs
+        # Only the colliding particles are rejected rather than the entire joint sample
+        particles = pose_dist.particles
+        weights = np.array(particles.weights)
+        while 0 < np.sum(weights):
+            index = np.random.choice(len(weights), p=weights / np.sum(weights))
+            pose = particles.get_pose(index)
+            if not any(self.test(name, pose, other, other_pose) for other, other_pose in placed.items()):
+                return pose
+            weights[index] = 0.
+        return None
+    def sample(self, pose_dists, max_attempts=MAX_JOINT_ATTEMPTS):
+        # Returns a collision-free assignment of poses (or None after max_attempts)
+        self.update_kitchen()
+        for _ in range(max_attempts):
+            poses = {}
+            for name, pose_dist in randomize(pose_dists.items()):
+                pose = self.sample_pose(name, pose_dist, poses)
+                if pose is None:
+                    break
+                poses[name] = pose
+            else:
+                for pose in poses.values():
+                    pose.assign()
+                return poses
+        return None
+    def __repr__(self):
+        return '{}(entries={}, hits={}, misses={})'.format(
+            self.__class__.__name__, len(self.collisions), self.hits, self.misses)
@@ -6,7 +6,8 @@ import time
 
 from pybullet_tools.utils import get_moving_links, set_joint_positions, create_attachment, \
     wait_for_duration, flatten_links, remove_handles, \
-    batch_ray_collision, draw_ray, wait_for_user, WorldSaver, adjust_path, waypoints_from_path
+    draw_ray, wait_for_user, WorldSaver, adjust_path, waypoints_from_path
+from src.raycache import get_ray_collision_fn
 from src.retime import interpolate_path, decompose_into_paths
 from src.utils import create_surface_attachment, SPAM, TOMATO_SOUP, MUSTARD, SUGAR, CHEEZIT
 
@@ -301,7 +302,7 @@ class Detect(Command):
     def surface_name(self):
         return self.pose.support
     def ray_collision(self):
-        return batch_ray_collision(self.rays)
+        return get_ray_collision_fn(self.world)(self.rays)
     def compute_occluding(self):
         # TODO: compute as a fraction of the rays
         return {(result.objectUniqueId, frozenset([result.linkIndex]))
@@ -1,9 +1,24 @@
+from __future__ import print_function
+
+import atexit
+import errno
+import fcntl
+import glob
+import json
 import os
 import random
+import tempfile
+import time
+import numpy as np
+
+from multiprocessing import Pool, cpu_count
 
-from pybullet_tools.utils import read_json, link_from_name, get_link_pose, multiply, \
+from pybullet_tools.utils import read_json, write_json, safe_remove, elapsed_time, link_from_name, get_link_pose, multiply, \
     euler_from_quat, draw_point, wait_for_user, set_joint_positions, joints_from_names, parent_link_from_joint, has_gui, \
-    point_from_pose, RED, child_link_from_joint, get_pose, get_point, invert, base_values_from_pose
+    point_from_pose, RED, child_link_from_joint, get_pose, get_point, invert, base_values_from_pose, grow_polygon
+from src.poses import POSE_LENGTH, array_from_pose, pose_from_array, array_from_poses, poses_from_array, multiply_poses, \
+    invert_poses, project_base_poses
+from src.occupancy import OccupancyGrid
 from src.utils import GRASP_TYPES, surface_from_name, BASE_JOINTS, joint_from_name, unit_pose, ALL_SURFACES, KNOBS
 
 DATABASE_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'databases/')
@@ -13,6 +28,32 @@ PLACE_IR_FILENAME = '{robot_name}-{surface_name}-{grasp_type}-place.json'
 PULL_IR_FILENAME = '{}-{}-pull.json'
 PRESS_IR_FILENAME = '{}-{}-press.json'
 
+COMPILED_EXTENSION = '.npy'
+RASTER_SUFFIX = '-raster.npz'
+SHARD_DIRECTORY = os.path.join(DATABASE_DIRECTORY, 'shards/')
+SHARD_EXTENSION = '.jsonl'
+STATS_DIRECTORY = os.path.join(DATABASE_DIRECTORY, 'stats/')
+
+MAX_DATABASE_ENTRIES = None # None | 250 (farthest-point subsamples larger databases when loaded)
+
+POSITION_TOLERANCE = 1e-3 # Entries closer than this are duplicates
+ORIENTATION_TOLERANCE = np.pi / 180
+
+GROW_INVERSE_BASE = 0.05 # 0.05 | 0.1
+GROW_FORWARD_RADIUS = 0.25 # Done for block. Incorrect for other object types
+
+RANDOM_ORDER = 'random'
+RANKED_ORDER = 'ranked'
+SUCCESS_ORDER = 'success'
+BASE_ORDERS = [RANDOM_ORDER, RANKED_ORDER, SUCCESS_ORDER]
+
+YAW_DISTANCE = 0.25 # Distance (m) between base confs that face opposite directions
+AVOID_RADIUS = 0.1
+AVOID_PENALTY = 1.0
+
+SUCCESS_PRIOR = (1., 1.) # Beta prior (successes, failures) that smooths the entry success rates
+RECORD_OUTCOMES = False # Records entry outcomes even when not ordering by SUCCESS_ORDER
+
 def get_surface_reference_pose(kitchen, surface_name):
     surface = surface_from_name(surface_name)
     link = link_from_name(kitchen, surface.link)
@@ -28,20 +69,181 @@ def project_base_pose(base_pose):
 
 ################################################################################
 
+def get_compiled_path(path):
+    return os.path.splitext(path)[0] + COMPILED_EXTENSION
+
+def is_compiled(path):
+    compiled_path = get_compiled_path(path)
+    if not os.path.exists(compiled_path):
+        return False
+    return not os.path.exists(path) or (os.path.getmtime(path) <= os.path.getmtime(compiled_path))
+
+def save_atomic(path, save_fn):
+    # Writes to a temporary file in the same directory and renames it into place
+    # Concurrent processes (e.g. run_experiment's Pool) never load or memory-map a partially written file
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix=os.path.basename(path))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            save_fn(f)
+        os.chmod(temp_path, 0o644) # mkstemp creates files that only the owner can read
+        os.rename(temp_path, path)
+    except:
+        safe_remove(temp_path)
+        raise
+
+def compile_database(path, save=True):
+    # Stores the entries as a structured array of records with a (7,) float32 pose per field
+    # The records are interleaved, so each field is a strided (not contiguous) view of the file
+    entries = read_json(path).get('entries', [])
+    fields = sorted(entries[0]) if entries else []
+    dtype = np.dtype([(field, np.float32, (POSE_LENGTH,)) for field in fields])
+    array = np.empty(len(entries), dtype=dtype)
+    for field in fields:
+        array[field] = [array_from_pose(entry[field]) for entry in entries]
+    if save:
+        try:
+            save_atomic(get_compiled_path(path), lambda f: np.save(f, array))
+        except (IOError, OSError) as e:
+            print('Unable to save {}: {}'.format(get_compiled_path(path), e))
+    return array
+
+def load_compiled_database(path):
+    # Memory-maps the compiled database, (re)compiling it when stale
+    if not is_compiled(path):
+        if not os.path.exists(path):
+            return None
+        array = compile_database(path)
+        if not is_compiled(path):
+            return array
+    compiled_path = get_compiled_path(path)
+    try:
+        return np.load(compiled_path, mmap_mode='r')
+    except ValueError: # Empty arrays cannot be memory-mapped
+        return np.load(compiled_path)
+
+def get_raster_path(path):
+    return os.path.splitext(path)[0] + RASTER_SUFFIX
+
+def is_rasterized(path):
+    raster_path = get_raster_path(path)
+    if not os.path.exists(raster_path):
+        return False
+    return not os.path.exists(path) or (os.path.getmtime(path) <= os.path.getmtime(raster_path))
+
+def get_grid_points(array, name):
+    # forward: object positions relative to the robot base
+    # base: robot base positions relative to the surface or joint reference frame
+    if array is None:
+        return np.zeros((0, 2))
+    if name == 'forward':
+        return array_from_field(array, 'base_from_object')[:, :2]
+    if name == 'base':
+        return base_values_from_array(array)[:, :2]
+    raise ValueError(name)
+
+def compute_grid(array, name, radius):
+    points = get_grid_points(array, name)
+    vertices = grow_polygon(points, radius=radius) if len(points) else []
+    return OccupancyGrid.from_polygon(vertices)
+
+def get_default_rasters(array):
+    if 'joint_from_base' in (array.dtype.names or []):
+        return [('base', GROW_INVERSE_BASE)]
+    return [('forward', GROW_FORWARD_RADIUS), ('base', GROW_INVERSE_BASE)]
+
+def compile_rasters(path, array=None, save=True):
+    # Rasterizes the default reachability polygons into {(name, radius): OccupancyGrid}
+    if array is None:
+        array = load_compiled_database(path)
+    if array is None:
+        return {}
+    grids = {(name, radius): compute_grid(array, name, radius)
+             for name, radius in get_default_rasters(array)}
+    if save:
+        arrays = {}
+        for (name, radius), grid in grids.items():
+            arrays[name] = grid.occupied
+            arrays[name + '_info'] = np.concatenate([grid.lower, [grid.resolution, radius]])
+        try:
+            save_atomic(get_raster_path(path), lambda f: np.savez(f, **arrays))
+        except (IOError, OSError) as e:
+            print('Unable to save {}: {}'.format(get_raster_path(path), e))
+    return grids
+
+def load_rasters(path, array=None):
+    # Loads the precomputed grids, (re)rasterizing them when stale
+    if not is_rasterized(path):
+        return compile_rasters(path, array=array)
+    grids = {}
+    with np.load(get_raster_path(path)) as data:
+        for name in data.files:
+            if name.endswith('_info'):
+                continue
+            x, y, resolution, radius = data[name + '_info']
+            grids[name, float(radius)] = OccupancyGrid(data[name], [x, y], resolution)
+    return grids
+
+def array_from_field(array, field):
+    # A float32 view (memory-mapped when array is) that is cast to float by the batch pose operations when used
+    if (array is None) or (field not in (array.dtype.names or [])):
+        return np.zeros((0, POSE_LENGTH))
+    return array[field]
+
+def poses_from_field(array, field):
+    return poses_from_array(array_from_field(array, field))
+
+def entries_from_array(array):
+    if array is None:
+        return []
+    fields = array.dtype.names or []
+    return [{field: pose_from_array(row[field]) for field in fields} for row in array]
+
+def base_values_from_array(array):
+    # Base values relative to the surface or joint reference frame
+    if 'joint_from_base' in (array.dtype.names or []):
+        return project_base_poses(array_from_field(array, 'joint_from_base'))
+    return project_base_poses(multiply_poses(array_from_field(array, 'surface_from_object'),
+                                             invert_poses(array_from_field(array, 'base_from_object'))))
+
+def farthest_point_indices(points, k):
+    # Greedy farthest-point sampling starting from the point closest to the centroid
+    points = np.asarray(points)
+    if len(points) <= k:
+        return list(range(len(points)))
+    distances = np.linalg.norm(points - np.average(points, axis=0), axis=1)
+    indices = [int(np.argmin(distances))]
+    distances = np.linalg.norm(points - points[indices[-1]], axis=1)
+    while len(indices) < k:
+        indices.append(int(np.argmax(distances)))
+        distances = np.minimum(distances, np.linalg.norm(points - points[indices[-1]], axis=1))
+    return indices
+
+def subsample_indices(array, k):
+    # Indices of the database entries that are kept
+    if array is None:
+        return np.zeros(0, dtype=int)
+    if (k is None) or (len(array) <= k):
+        return np.arange(len(array))
+    return np.array(sorted(farthest_point_indices(embed_base_values(base_values_from_array(array)), k)))
+
+################################################################################
+
 def get_place_path(robot_name, surface_name, grasp_type):
     return os.path.abspath(os.path.join(DATABASE_DIRECTORY, PLACE_IR_FILENAME.format(
         robot_name=robot_name, surface_name=surface_name, grasp_type=grasp_type)))
 
 def has_place_database(robot_name, surface_name, grasp_type):
-    return os.path.exists(get_place_path(robot_name, surface_name, grasp_type))
+    path = get_place_path(robot_name, surface_name, grasp_type)
+    return os.path.exists(path) or os.path.exists(get_compiled_path(path))
+
+def load_place_array(robot_name, surface_name, grasp_type):
+    return load_compiled_database(get_place_path(robot_name, surface_name, grasp_type))
 
 def load_place_entries(robot_name, surface_name, grasp_type):
-    if not has_place_database(robot_name, surface_name, grasp_type):
-        return []
-    return read_json(get_place_path(robot_name, surface_name, grasp_type)).get('entries', [])
+    return entries_from_array(load_place_array(robot_name, surface_name, grasp_type))
 
 def load_place_database(robot_name, surface_name, grasp_type, field):
-    return [entry[field] for entry in load_place_entries(robot_name, surface_name, grasp_type)]
+    return list(get_place_database(robot_name, surface_name, grasp_type).poses[field])
 
 def load_placements(world, surface_name, grasp_types=GRASP_TYPES):
     # TODO: could also annotate which grasp came with which placement
@@ -60,39 +262,113 @@ def load_forward_placements(world, surface_names=ALL_SURFACES, grasp_types=GRASP
                                                          field='base_from_object'))
     return base_from_objects
 
-def load_place_base_poses(world, tool_pose, surface_name, grasp_type):
+def iterate_base_values(base_values):
+    # Shuffled like the per-pose generators but computed in a single vectorized pass
+    for index in np.random.permutation(len(base_values)):
+        yield tuple(map(float, base_values[index]))
+
+def embed_base_values(base_values, yaw_distance=YAW_DISTANCE):
+    # Euclidean distance in this space approximates a weighted SE(2) distance
+    x, y, yaw = np.atleast_2d(base_values).T
+    return np.column_stack([x, y, yaw_distance*np.cos(yaw) / 2, yaw_distance*np.sin(yaw) / 2])
+
+def iterate_ranked_base_values(base_values, target_values, avoid=[],
+                               radius=AVOID_RADIUS, penalty=AVOID_PENALTY):
+    # avoid may grow while iterating (e.g. with base confs rejected by inverse_reachability)
+    from scipy.spatial import cKDTree
+    if not len(base_values):
+        return
+    tree = cKDTree(embed_base_values(base_values))
+    [target_point] = embed_base_values(target_values)
+    distances, indices = tree.query(target_point, k=len(base_values))
+    scores = np.zeros(len(base_values))
+    scores[np.atleast_1d(indices)] = np.atleast_1d(distances)
+    remaining = np.ones(len(base_values), dtype=bool)
+    num_avoided = 0
+    while np.any(remaining):
+        for avoid_point in embed_base_values(avoid[num_avoided:]) if avoid[num_avoided:] else []:
+            scores[tree.query_ball_point(avoid_point, r=radius)] += penalty
+        num_avoided = len(avoid)
+        index = np.argmin(np.where(remaining, scores, np.inf))
+        remaining[index] = False
+        yield tuple(map(float, base_values[index]))
+
+def iterate_weighted_base_values(base_values, weights):
+    # Samples without replacement in proportion to the (positive) weights
+    if not len(base_values):
+        return
+    probabilities = np.array(weights, dtype=float) / np.sum(weights)
+    for index in np.random.choice(len(base_values), size=len(base_values), replace=False, p=probabilities):
+        yield tuple(map(float, base_values[index]))
+
+def order_base_values(world, base_values, order=RANDOM_ORDER, target=None, avoid=[], weights=None):
+    if order == RANDOM_ORDER:
+        return iterate_base_values(base_values)
+    if order == RANKED_ORDER:
+        if target is None:
+            target = world.get_base_conf()
+        return iterate_ranked_base_values(base_values, target, avoid=avoid)
+    if order == SUCCESS_ORDER:
+        if weights is None:
+            weights = np.ones(len(base_values))
+        return iterate_weighted_base_values(base_values, weights)
+    raise ValueError(order)
+
+def is_recording(order):
+    return RECORD_OUTCOMES or (order == SUCCESS_ORDER)
+
+def order_database_values(world, database, base_values, context=None, proposals=None, order=RANDOM_ORDER, **kwargs):
+    # proposals maps each base value to the database entry that proposed it (only when recording outcomes)
+    if (proposals is not None) and is_recording(order):
+        proposals.update((tuple(map(float, values)), (database, index))
+                         for values, index in zip(base_values, database.indices))
+    weights = database.get_success_rates(context) if order == SUCCESS_ORDER else None
+    return order_base_values(world, base_values, order=order, weights=weights, **kwargs)
+
+def record_base_outcome(proposals, base_values, context, success):
+    # Credits the database entry that proposed base_values, if any
+    if (proposals is None) or (tuple(base_values) not in proposals):
+        return False
+    database, index = proposals[tuple(base_values)]
+    database.record_outcome(context, index, success)
+    return True
+
+def load_place_base_poses(world, tool_pose, surface_name, grasp_type, **kwargs):
     # TODO: Gaussian perturbation
-    gripper_from_base_list = load_place_database(world.robot_name, surface_name, grasp_type,
-                                                 field='tool_from_base')
-    random.shuffle(gripper_from_base_list)
-    handles = []
-    for gripper_from_base in gripper_from_base_list:
-        #world_from_model = get_pose(world.robot)
-        world_from_model = unit_pose()
-        base_values = project_base_pose(multiply(invert(world_from_model), tool_pose, gripper_from_base))
-        #x, y, _ = base_values
-        #_, _, z = get_point(world.floor)
-        #set_joint_positions(world.robot, joints_from_names(world.robot, BASE_JOINTS), base_values)
-        #handles.extend(draw_point(np.array([x, y, z + 0.01]), color=(1, 0, 0), size=0.05))
-        #wait_for_user()
-        yield base_values
+    database = get_place_database(world.robot_name, surface_name, grasp_type)
+    #world_from_model = get_pose(world.robot)
+    world_from_model = unit_pose()
+    world_from_bases = multiply_poses(invert_poses(array_from_pose(world_from_model)),
+                                      array_from_pose(tool_pose), database.arrays['tool_from_base'])
+    return order_database_values(world, database, project_base_poses(world_from_bases), **kwargs)
 
 def load_inverse_placements(world, surface_name, grasp_types=GRASP_TYPES):
     surface_from_bases = []
     for grasp_type in grasp_types:
-        for entry in load_place_entries(world.robot_name, surface_name, grasp_type):
-            surface_from_bases.append(multiply(entry['surface_from_object'],
-                                               invert(entry['base_from_object'])))
+        database = get_place_database(world.robot_name, surface_name, grasp_type)
+        surface_from_bases.extend(database.surface_from_base)
     random.shuffle(surface_from_bases)
     return surface_from_bases
 
-def load_pour_base_poses(world, surface_name, **kwargs):
+def get_forward_grids(world, surface_names=ALL_SURFACES, grasp_types=GRASP_TYPES, radius=GROW_FORWARD_RADIUS):
+    grids = [get_place_database(world.robot_name, surface_name, grasp_type).get_grid('forward', radius)
+             for surface_name in surface_names for grasp_type in grasp_types]
+    return [grid for grid in grids if grid]
+
+def get_inverse_grids(world, surface_name, grasp_types=GRASP_TYPES, radius=GROW_INVERSE_BASE):
+    grids = [get_place_database(world.robot_name, surface_name, grasp_type).get_grid('base', radius)
+             for grasp_type in grasp_types]
+    return [grid for grid in grids if grid]
+
+def load_pour_base_poses(world, surface_name, grasp_types=GRASP_TYPES):
     world_from_surface = get_surface_reference_pose(world.kitchen, surface_name)
-    for surface_from_base in load_inverse_placements(world, surface_name, **kwargs):
-        base_values = project_base_pose(multiply(world_from_surface, surface_from_base))
-        #world.set_base_conf(base_values)
-        #wait_for_user()
-        yield base_values
+    surface_from_bases = np.concatenate([
+        get_place_database(world.robot_name, surface_name, grasp_type).surface_from_base_array
+        for grasp_type in grasp_types])
+    world_from_bases = multiply_poses(array_from_pose(world_from_surface), surface_from_bases)
+    #world.set_base_conf(base_values)
+    #wait_for_user()
+    return iterate_base_values(project_base_poses(world_from_bases))
 
 ################################################################################
 
@@ -110,27 +386,356 @@ def get_pull_path(robot_name, joint_name):
     ir_filename = PRESS_IR_FILENAME if is_press(joint_name) else PULL_IR_FILENAME
     return os.path.abspath(os.path.join(DATABASE_DIRECTORY, ir_filename.format(robot_name, joint_name)))
 
+def load_pull_array(robot_name, joint_name):
+    return load_compiled_database(get_pull_path(robot_name, joint_name))
+
 def load_pull_database(robot_name, joint_name):
-    data = {}
-    path = get_pull_path(robot_name, joint_name)
-    if os.path.exists(path):
-        data = read_json(path)
-    return [entry['joint_from_base'] for entry in data.get('entries', [])]
-
-def load_pull_base_poses(world, joint_name):
-    joint_from_base_list = load_pull_database(world.robot_name, joint_name)
+    return list(get_pull_database(robot_name, joint_name).joint_from_base)
+
+def get_joint_grids(world, joint_name, radius=GROW_INVERSE_BASE):
+    grid = get_pull_database(world.robot_name, joint_name).get_grid('base', radius)
+    return [grid] if grid else []
+
+def load_pull_base_poses(world, joint_name, **kwargs):
+    database = get_pull_database(world.robot_name, joint_name)
     parent_pose = get_joint_reference_pose(world.kitchen, joint_name)
-    random.shuffle(joint_from_base_list)
-    handles = []
-    for joint_from_base in joint_from_base_list:
-        #world_from_model = get_pose(world.robot)
-        world_from_model = unit_pose()
-        base_values = project_base_pose(multiply(invert(world_from_model), parent_pose, joint_from_base))
-        #set_joint_positions(world.robot, joints_from_names(world.robot, BASE_JOINTS), base_values)
-        #x, y, _ = base_values
-        #handles.extend(draw_point(np.array([x, y, -0.1]), color=(1, 0, 0), size=0.05))
-        yield base_values
-    #wait_for_user()
+    #world_from_model = get_pose(world.robot)
+    world_from_model = unit_pose()
+    world_from_bases = multiply_poses(invert_poses(array_from_pose(world_from_model)),
+                                      array_from_pose(parent_pose), database.arrays['joint_from_base'])
+    return order_database_values(world, database, project_base_poses(world_from_bases), **kwargs)
+
+################################################################################
+
+def get_stats_path(path):
+    return os.path.abspath(os.path.join(STATS_DIRECTORY, get_database_name(path) + SHARD_EXTENSION))
+
+def add_outcomes(stats, context, index, attempts, successes):
+    context_stats = stats.setdefault(context, {})
+    previous_attempts, previous_successes = context_stats.get(index, (0, 0))
+    context_stats[index] = (previous_attempts + attempts, previous_successes + successes)
+
+def lines_from_stats(stats):
+    return ''.join(json.dumps({'context': context, 'index': index, 'attempts': attempts, 'successes': successes},
+                              sort_keys=True) + '\n'
+                   for context in sorted(stats) for index, (attempts, successes) in sorted(stats[context].items()))
+
+def load_entry_stats(path):
+    # Folds the outcomes appended by every process into {context: {index: (attempts, successes)}}
+    # The file is rewritten with one line per (context, index) when it has accumulated more
+    stats = {}
+    stats_path = get_stats_path(path)
+    if not os.path.exists(stats_path):
+        return stats
+    num_lines = 0
+    with open(stats_path, 'r+') as f:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX) # Excludes concurrent flush_outcomes
+        for line in f:
+            num_lines += 1
+            try:
+                outcome = json.loads(line)
+            except ValueError: # Interrupted while writing the last line
+                print('Skipping a truncated outcome in', stats_path)
+                continue
+            # Single outcomes ({'success': bool}) are from before the counts were folded
+            add_outcomes(stats, outcome['context'], outcome['index'], outcome.get('attempts', 1),
+                         outcome.get('successes', int(outcome.get('success', False))))
+        if sum(map(len, stats.values())) < num_lines:
+            f.seek(0)
+            f.write(lines_from_stats(stats))
+            f.truncate()
+    return stats
+
+PENDING_DATABASES = set()
+
+def flush_outcomes():
+    # Called once per stream output (and at exit) rather than once per attempt
+    for database in list(PENDING_DATABASES):
+        database.flush_outcomes()
+
+atexit.register(flush_outcomes)
+
+def get_database_mtime(path):
+    mtimes = [os.path.getmtime(p) for p in [path, get_compiled_path(path)] if os.path.exists(p)]
+    if not mtimes:
+        return None
+    return max(mtimes)
+
+class Database(object):
+    # Loaded once per process and reloaded when the underlying file changes
+    cache = {}
+    def __init__(self, path, max_entries=None):
+        self.path = path
+        array = load_compiled_database(path)
+        self.mtime = get_database_mtime(path) # After (re)compiling, which updates the mtime
+        self.indices = subsample_indices(array, max_entries) # Entry indices in the full database
+        subsampled = (array is not None) and (len(self.indices) != len(array))
+        self.array = array[self.indices] if subsampled else array
+        self.stats = load_entry_stats(path)
+        self.pending = {} # Outcomes that have not been written yet
+        self.grids = {} if subsampled else load_rasters(path, array=array)
+    @property
+    def fields(self):
+        if self.array is None:
+            return []
+        return list(self.array.dtype.names or [])
+    def is_stale(self):
+        return self.mtime != get_database_mtime(self.path)
+    def __len__(self):
+        return 0 if self.array is None else len(self.array)
+    def get_grid(self, name, radius):
+        if (name, radius) not in self.grids:
+            self.grids[name, radius] = compute_grid(self.array, name, radius)
+        return self.grids[name, radius]
+    def get_success_rates(self, context, prior=SUCCESS_PRIOR):
+        attempts = np.zeros(len(self))
+        successes = np.zeros(len(self))
+        positions = {index: position for position, index in enumerate(self.indices)}
+        for index, (num_attempts, num_successes) in self.stats.get(context, {}).items():
+            if index in positions:
+                attempts[positions[index]] = num_attempts
+                successes[positions[index]] = num_successes
+        alpha, beta = prior
+        return (successes + alpha) / (attempts + alpha + beta)
+    def record_outcome(self, context, index, success):
+        # Buffered until flush_outcomes
+        index = int(index)
+        add_outcomes(self.stats, context, index, 1, int(success))
+        add_outcomes(self.pending, context, index, 1, int(success))
+        PENDING_DATABASES.add(self)
+    def flush_outcomes(self):
+        # Appended rather than rewritten so that concurrent processes do not clobber each other
+        PENDING_DATABASES.discard(self)
+        if not self.pending:
+            return
+        if not os.path.exists(STATS_DIRECTORY):
+            os.makedirs(STATS_DIRECTORY)
+        with open(get_stats_path(self.path), 'a') as f:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            f.write(lines_from_stats(self.pending))
+        self.pending = {}
+    @classmethod
+    def load(cls, *key):
+        max_entries = MAX_DATABASE_ENTRIES
+        database = cls.cache.get((cls, key, max_entries), None)
+        if (database is None) or database.is_stale():
+            if database is not None:
+                database.flush_outcomes()
+            database = cls(*key, max_entries=max_entries)
+            cls.cache[cls, key, max_entries] = database
+        return database
+
+class PlacementDatabase(Database):
+    def __init__(self, robot_name, surface_name, grasp_type, **kwargs):
+        super(PlacementDatabase, self).__init__(get_place_path(robot_name, surface_name, grasp_type), **kwargs)
+        self.robot_name = robot_name
+        self.surface_name = surface_name
+        self.grasp_type = grasp_type
+        self.arrays = {field: array_from_field(self.array, field)
+                       for field in ['tool_from_base', 'surface_from_object', 'base_from_object']}
+        self.derived = {} # Derived values are only computed (and read from disk) when first used
+    @property
+    def poses(self):
+        if 'poses' not in self.derived:
+            self.derived['poses'] = {field: tuple(poses_from_array(array)) for field, array in self.arrays.items()}
+        return self.derived['poses']
+    @property
+    def surface_from_base_array(self):
+        if 'surface_from_base_array' not in self.derived:
+            self.derived['surface_from_base_array'] = multiply_poses(self.arrays['surface_from_object'],
+                                                                     invert_poses(self.arrays['base_from_object']))
+        return self.derived['surface_from_base_array']
+    @property
+    def surface_from_base(self):
+        if 'surface_from_base' not in self.derived:
+            self.derived['surface_from_base'] = tuple(poses_from_array(self.surface_from_base_array))
+        return self.derived['surface_from_base']
+    def __repr__(self):
+        return '{}({}, {}, {}, {})'.format(self.__class__.__name__, self.robot_name,
+                                           self.surface_name, self.grasp_type, len(self))
+
+class PullDatabase(Database):
+    def __init__(self, robot_name, joint_name, **kwargs):
+        super(PullDatabase, self).__init__(get_pull_path(robot_name, joint_name), **kwargs)
+        self.robot_name = robot_name
+        self.joint_name = joint_name
+        self.arrays = {'joint_from_base': array_from_field(self.array, 'joint_from_base')}
+        self.derived = {}
+    @property
+    def joint_from_base(self):
+        if 'joint_from_base' not in self.derived:
+            self.derived['joint_from_base'] = tuple(poses_from_array(self.arrays['joint_from_base']))
+        return self.derived['joint_from_base']
+    def __repr__(self):
+        return '{}({}, {}, {})'.format(self.__class__.__name__, self.robot_name,
+                                       self.joint_name, len(self))
+
+def get_place_database(robot_name, surface_name, grasp_type):
+    return PlacementDatabase.load(robot_name, surface_name, grasp_type)
+
+def get_pull_database(robot_name, joint_name):
+    return PullDatabase.load(robot_name, joint_name)
+
+################################################################################
+
+# Collection appends each entry to a shard as it succeeds and later compacts the shards into the database
+
+def get_database_name(path):
+    return os.path.splitext(os.path.basename(path))[0]
+
+def get_shard_paths(path):
+    return sorted(glob.glob(os.path.join(SHARD_DIRECTORY, '{}.*{}'.format(
+        get_database_name(path), SHARD_EXTENSION))))
+
+def create_shard_path(path, date):
+    if not os.path.exists(SHARD_DIRECTORY):
+        os.makedirs(SHARD_DIRECTORY)
+    return os.path.abspath(os.path.join(SHARD_DIRECTORY, '{}.{}-{}{}'.format(
+        get_database_name(path), date, os.getpid(), SHARD_EXTENSION)))
+
+def get_shard_pid(shard_path):
+    # Shards are named {database}.{date}-{pid}.jsonl
+    name = os.path.basename(shard_path)[:-len(SHARD_EXTENSION)]
+    try:
+        return int(name.rsplit('-', 1)[-1])
+    except ValueError:
+        return None
+
+def is_process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+def get_compactable_shard_paths(path):
+    # Shards of other running processes may still be appended to
+    return [shard_path for shard_path in get_shard_paths(path)
+            if get_shard_pid(shard_path) in (None, os.getpid()) or not is_process_alive(get_shard_pid(shard_path))]
+
+def append_shard_entry(shard_path, entry):
+    with open(shard_path, 'a') as f:
+        f.write(json.dumps(entry, sort_keys=True) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+
+def read_shard_entries(shard_paths):
+    entries = []
+    for shard_path in shard_paths:
+        with open(shard_path, 'r') as f:
+            for line in f:
+                try:
+                    entries.append(json.loads(line))
+                except ValueError: # Interrupted while writing the last entry
+                    print('Skipping a truncated entry in', shard_path)
+    return entries
+
+def load_collected_entries(path):
+    entries = read_json(path).get('entries', []) if os.path.exists(path) else []
+    return entries + read_shard_entries(get_shard_paths(path))
+
+def start_shard(path, date):
+    # Resumes from previously collected entries and streams new ones to an append-only shard
+    num_existing = len(load_collected_entries(path))
+    shard_path = create_shard_path(path, date)
+    print('Existing entries: {} | Shard: {}'.format(num_existing, shard_path))
+    return num_existing, shard_path
+
+def dedupe_entries(entries, position_tolerance=POSITION_TOLERANCE,
+                   orientation_tolerance=ORIENTATION_TOLERANCE):
+    # Keeps the first of any entries whose poses are all within tolerance of each other
+    from scipy.spatial import cKDTree
+    if not entries:
+        return []
+    fields = sorted(entries[0])
+    arrays = [array_from_poses([entry[field] for entry in entries]) for field in fields]
+    points = np.hstack([array[:, :3] for array in arrays])
+    tree = cKDTree(points)
+    kept = np.zeros(len(entries), dtype=bool)
+    for index in range(len(entries)):
+        kept[index] = True
+        for neighbor in tree.query_ball_point(points[index], r=position_tolerance, p=np.inf):
+            if (index <= neighbor) or not kept[neighbor]:
+                continue
+            dots = [np.abs(np.dot(array[index, 3:], array[neighbor, 3:])) for array in arrays]
+            if all(2*np.arccos(min(dot, 1.)) <= orientation_tolerance for dot in dots):
+                kept[index] = False
+                break
+    return [entry for entry, keep in zip(entries, kept) if keep]
+
+def compact_database(path, data={}, **kwargs):
+    # Merges the database with this process's shards (and those of exited processes),
+    # drops near duplicates, and removes the merged shards
+    # The lock prevents concurrent compactions from overwriting each other's results
+    if not os.path.exists(SHARD_DIRECTORY):
+        os.makedirs(SHARD_DIRECTORY)
+    lock_path = os.path.join(SHARD_DIRECTORY, get_database_name(path) + '.lock')
+    while True:
+        lock = open(lock_path, 'a')
+        fcntl.flock(lock.fileno(), fcntl.LOCK_EX) # Released when the file is closed (or the process exits)
+        try:
+            if os.path.samestat(os.fstat(lock.fileno()), os.stat(lock_path)):
+                break
+        except OSError:
+            pass
+        lock.close() # Removed by the previous holder after we opened it
+    try:
+        return compact_shards(path, get_compactable_shard_paths(path), data=data, **kwargs)
+    finally:
+        safe_remove(lock_path) # Before unlocking so that waiting processes reopen a new lock file
+        lock.close()
+
+def compact_shards(path, shard_paths, data={}, **kwargs):
+    previous = read_json(path) if os.path.exists(path) else {}
+    entries = previous.get('entries', []) + read_shard_entries(shard_paths)
+    num_entries = len(entries)
+    entries = dedupe_entries(entries, **kwargs)
+    compacted = dict(previous)
+    compacted.update(data)
+    compacted.update({
+        'entries': entries,
+        'failures': previous.get('failures', 0) + data.get('failures', 0),
+        'successes': len(entries),
+    })
+    if entries:
+        write_json(path, compacted)
+    for shard_path in shard_paths:
+        safe_remove(shard_path)
+    print('Compacted {} entries into {} ({} duplicates)'.format(
+        num_entries, len(entries), num_entries - len(entries)))
+    return compacted
+
+COLLECTOR = {} # The state of each collection worker process
+
+def initialize_collector(create_fn, args):
+    # Each worker owns a DIRECT-mode pybullet client
+    random.seed()
+    np.random.seed()
+    COLLECTOR['args'] = args
+    COLLECTOR['state'] = create_fn(args)
+
+def run_collector(task):
+    collect_fn, key = task
+    start_time = time.time()
+    data = collect_fn(COLLECTOR['state'], key, COLLECTOR['args'])
+    successes = 0 if data is None else data['successes']
+    return key, successes, elapsed_time(start_time)
+
+def collect_parallel(create_fn, collect_fn, keys, args):
+    # Calls collect_fn(create_fn(args), key, args) for each key across args.jobs worker processes
+    # Both functions must be defined at the top level of a module so that they can be pickled
+    num_jobs = min(args.jobs if 0 < args.jobs else cpu_count(), len(keys))
+    print('Jobs: {} | Tasks: {}'.format(num_jobs, len(keys)))
+    start_time = time.time()
+    pool = Pool(processes=num_jobs, initializer=initialize_collector, initargs=(create_fn, args))
+    try:
+        for i, (key, successes, runtime) in enumerate(
+                pool.imap_unordered(run_collector, [(collect_fn, key) for key in keys])):
+            print('Finished {} / {} | {} | Successes: {} | Time: {:.3f} | Elapsed: {:.3f}'.format(
+                i + 1, len(keys), key, successes, runtime, elapsed_time(start_time)))
+    finally:
+        pool.close()
+        pool.join()
 
 ################################################################################
 
@@ -0,0 +1,53 @@
+import numpy as np
+
+from scipy.special import logsumexp
+
+# Weighted Gaussian kernel density estimation over (x, y[, yaw]) particles
+
+YAW_WEIGHT = 0.01*np.pi # Distance (m) per radian of yaw
+
+def wrap_angles(angles):
+    return (np.array(angles) + np.pi) % (2*np.pi) - np.pi
+
+class KernelDensity(object):
+    def __init__(self, points, weights=None, bandwidth=0.01, yaw_weight=YAW_WEIGHT):
+        # The third dimension (if any) is yaw, which is treated circularly
+        self.points = np.array(points, dtype=float).reshape(len(points), -1)
+        num_points, dim = self.points.shape
+        assert 1 <= num_points
+        assert dim in (2, 3)
+        if weights is None:
+            weights = np.ones(num_points)
+        weights = np.array(weights, dtype=float)
+        self.weights = weights / np.sum(weights)
+        with np.errstate(divide='ignore'):
+            self.log_weights = np.log(self.weights)
+        self.bandwidths = np.full(dim, bandwidth, dtype=float)
+        if dim == 3:
+            self.bandwidths[2] = bandwidth / yaw_weight
+        self.log_normalizer = -np.sum(np.log(np.sqrt(2*np.pi)*self.bandwidths))
+    @property
+    def dim(self):
+        return self.points.shape[1]
+    def get_deltas(self, points):
+        # (M, N, D) differences between each query point and each kernel center
+        deltas = np.array(points, dtype=float)[:, np.newaxis, :] - self.points[np.newaxis, :, :]
+        if self.dim == 3:
+            deltas[..., 2] = wrap_angles(deltas[..., 2])
+        return deltas
+    def log_prob(self, points):
+        points = np.array(points, dtype=float).reshape(-1, self.dim)
+        exponents = -np.sum(np.square(self.get_deltas(points) / self.bandwidths), axis=-1) / 2.
+        return logsumexp(exponents + self.log_weights, axis=1) + self.log_normalizer
+    def prob(self, points):
+        return np.exp(self.log_prob(points))
+    def sample(self, n=1):
+        indices = np.random.choice(len(self.points), size=n, p=self.weights)
+        samples = self.points[indices] + np.random.normal(scale=self.bandwidths, size=(n, self.dim))
+        if self.dim == 3:
+            samples[:, 2] = wrap_angles(samples[:, 2])
+        return samples
+    def __len__(self):
+        return len(self.points)
+    def __repr__(self):
+        return '{}({}, {})'.format(self.__class__.__name__, len(self), self.bandwidths.round(3))
@@ -1,23 +1,33 @@
 from __future__ import print_function
 
+import time
+import math
 import numpy as np
 import scipy
 
+from scipy.special import logsumexp
+
 from collections import namedtuple
 from scipy.stats import norm, truncnorm
-from sklearn.neighbors import KernelDensity
 
 from examples.discrete_belief.dist import UniformDist, DDist, DeltaDist, mixDDists, ProductDistribution, \
     GaussianDistribution, Distribution
-from pybullet_tools.pr2_utils import is_visible_point
 from pybullet_tools.utils import base_values_from_pose, CIRCULAR_LIMITS, stable_z_on_aabb, point_from_pose, Point, Pose, \
     Euler, set_pose, multiply, draw_circle, LockRenderer, BodySaver, Ray, batch_ray_collision, draw_ray, wrap_angle, \
-    circular_difference, remove_handles, get_pose, pairwise_collision, GREEN
+    circular_difference, remove_handles, get_pose, pairwise_collision, GREEN, INF, elapsed_time
 from src.database import get_surface_reference_pose
-from src.utils import compute_surface_aabb, create_relative_pose, CAMERA_MATRIX, KINECT_DEPTH, Z_EPSILON, test_supported
+from src.density import KernelDensity, wrap_angles
+from src.poses import array_from_pose, rotate_points
+from src.raycache import get_ray_collision_fn
+from src.particles import Particles, values_from_pose, get_reference_from_body, kld_particle_count
+from src.visibility import get_visible_masks, get_camera_views, get_camera_rays, \
+    compute_occlusion_masks
+from src.workers import get_world_state, compute_visible_masks
+from src.utils import compute_surface_aabb, create_relative_pose, Z_EPSILON, test_supported
 
 BAYESIAN = False
 RESAMPLE = False
+ADAPTIVE_RESAMPLE = True # Systematic resampling with a KLD-sampling particle count
 
 MODEL_P_FP, MODEL_P_FN = 0.0, 1e-4
 MODEL_POS_STD, MODEL_ORI_STD = 0.01, np.pi / 8
@@ -27,7 +37,17 @@ DIM = 2
 assert DIM in (2, 3)
 
 NUM_PARTICLES = 100 # 100 | 250
+PRUNE_PROB = 1e-6 # Particles with less posterior probability are removed
+MERGE_BIN_SIZES = np.array([5e-3, 5e-3, np.pi/16])[:DIM] # x, y, yaw
+MAX_SUPPORT = 250 # Most likely particles retained after merging
+MIN_PARTICLES = 10
+KLD_EPSILON, KLD_DELTA = 0.05, 0.01
+KLD_BIN_SIZES = np.array([0.05, 0.05, np.pi/4])[:DIM] # x, y, yaw
+UPDATE_WORKERS = 0 # Worker processes that ray trace the Monte Carlo updates (0 traces in process)
 NEARBY_RADIUS = 5e-2
+SAMPLE_BATCH_SIZE = 25 # Candidates drawn from the density at once
+MAX_SAMPLE_ATTEMPTS = 250 # Candidates drawn before sample_surface_pose gives up
+MAX_SAMPLE_TIME = INF
 Neighborhood = namedtuple('Neighborhood', ['poses', 'prob'])
 
 ################################################################################
@@ -35,42 +55,91 @@ Neighborhood = namedtuple('Neighborhood', ['poses', 'prob'])
 class PoseDist(object):
     # TODO: maintain one of these for each surface instead?
     # It is nice to treat them all as one distribution though
+    # dist may either be a DDist over RelPoses or Particles
+    # Each representation is derived from the other when first accessed
     def __init__(self, world, name, dist, weight=1.0, bandwidth=0.01):
         self.world = world
         self.name = name
-        self.dist = dist
-        self.poses_from_surface = {}
-        for pose in self.dist.support():
-            self.poses_from_surface.setdefault(pose.support, []).append(pose)
-        self.surface_dist = self.dist.project(lambda p: p.support)
+        self._dist = None
+        self._dist_version = None
+        self._particles = None
+        if isinstance(dist, Particles):
+            self._particles = dist
+            self.surface_dist = DDist(dict(zip(dist.surfaces, dist.get_surface_weights())))
+        else:
+            self._dist = dist
+            self.surface_dist = dist.project(lambda p: p.support)
         self.density_from_surface = {}
         self.weight = weight
         self.bandwidth = bandwidth
         self.handles = []
+    @property
+    def dist(self):
+        if (self._dist is None) or ((self._particles is not None) and (self._dist_version != self._particles.version)):
+            self._dist = self._particles.to_dist()
+            self._dist_version = self._particles.version
+        return self._dist
+    @property
+    def particles(self):
+        if self._particles is None:
+            self._particles = Particles.from_dist(self.world, self.name, self._dist)
+            self._dist_version = self._particles.version
+        return self._particles
+    @property
+    def poses_from_surface(self):
+        poses_from_surface = {}
+        for pose in self.dist.support():
+            poses_from_surface.setdefault(pose.support, []).append(pose)
+        return poses_from_surface
     def is_localized(self):
+        if self._particles is not None:
+            return len(self._particles) == 1
         return len(self.dist.support()) == 1
+    def surface_probs(self, surfaces):
+        return self.weight * np.array([self.surface_dist.prob(surface) for surface in surfaces], dtype=float)
     def surface_prob(self, surface):
-        return self.weight * self.surface_dist.prob(surface)
+        [prob] = self.surface_probs([surface])
+        return prob
+    def discrete_probs(self, poses):
+        if self._particles is None:
+            return self.weight * np.array([self.dist.prob(pose) for pose in poses], dtype=float)
+        indices = np.array([self._particles.get_index(pose) for pose in poses], dtype=object)
+        known = np.array([index is not None for index in indices], dtype=bool)
+        probs = np.zeros(len(poses))
+        probs[known] = self._particles.weights[indices[known].astype(int)]
+        return self.weight * probs
     def discrete_prob(self, pose):
-        return self.weight * self.dist.prob(pose)
+        [prob] = self.discrete_probs([pose])
+        return prob
+    def probs(self, poses):
+        # Evaluates one batch per surface
+        probs = np.zeros(len(poses))
+        indices_from_surface = {}
+        for index, pose in enumerate(poses):
+            indices_from_surface.setdefault(pose.support, []).append(index)
+        for surface, indices in indices_from_surface.items():
+            density = self.get_density(surface)
+            if density is None:
+                continue
+            scores = density.log_prob([self.pose2d_from_pose(poses[index]) for index in indices])
+            probs[indices] = self.surface_prob(surface) * np.exp(-scores)
+        return probs
     def prob(self, pose):
-        support = pose.support
-        density = self.get_density(support)
-        pose2d = self.pose2d_from_pose(pose)
-        [score] = density.score_samples([pose2d])
-        prob = np.exp(-score)
-        return self.surface_prob(support) * prob
+        [prob] = self.probs([pose])
+        return prob
     #def support(self):
     #    return self.dist.support()
 
     def pose2d_from_pose(self, pose):
-        return base_values_from_pose(pose.get_reference_from_body())[:DIM]
-    def pose_from_pose2d(self, pose2d, surface):
+        return values_from_pose(pose)[:DIM]
+    def pose_from_pose2d(self, pose2d, surface, surface_aabb=None, world_from_surface=None):
         #assert surface in self.poses_from_surface
         #reference_pose = self.poses_from_surface[surface][0]
         body = self.world.get_body(self.name)
-        surface_aabb = compute_surface_aabb(self.world, surface)
-        world_from_surface = get_surface_reference_pose(self.world.kitchen, surface)
+        if surface_aabb is None:
+            surface_aabb = compute_surface_aabb(self.world, surface)
+        if world_from_surface is None:
+            world_from_surface = get_surface_reference_pose(self.world.kitchen, surface)
         if DIM == 2:
             x, y = pose2d[:DIM]
             yaw = np.random.uniform(*CIRCULAR_LIMITS)
@@ -83,78 +152,75 @@ class PoseDist(object):
         return create_relative_pose(self.world, self.name, surface)
 
     def get_density(self, surface):
+        # Cached until the particles change
+        particles = self.particles
         if surface in self.density_from_surface:
-            return self.density_from_surface[surface]
-        if surface not in self.poses_from_surface:
+            version, density = self.density_from_surface[surface]
+            if version == particles.version:
+                return density
+        mask = particles.get_surface_mask(surface) & (0 < particles.weights)
+        if not np.any(mask):
             return None
-        points, weights = zip(*[(self.pose2d_from_pose(pose), self.dist.prob(pose))
-                                for pose in self.poses_from_surface[surface]])
-        #print(weights)
-        # from sklearn.mixture import GaussianMixture
-        # pip2 install -U --no-deps scikit-learn=0.20
-        # https://scikit-learn.org/stable/modules/density.html
-        # https://docs.scipy.org/doc/scipy/reference/generated/scipy.stats.gaussian_kde.html#scipy.stats.gaussian_kde
-        # https://scikit-learn.org/stable/modules/generated/sklearn.neighbors.DistanceMetric.html#sklearn.neighbors.DistanceMetric
-        # KernelDensity kernel: ['gaussian', 'tophat', 'epanechnikov', 'exponential', 'linear', 'cosine']
-        # KDTree.valid_metrics: ['chebyshev', 'euclidean', 'cityblock', 'manhattan', 'infinity', 'minkowski', 'p', 'l2', 'l1']
-        # BallTree.valid_metrics: ['chebyshev', 'sokalmichener', 'canberra', 'haversine', 'rogerstanimoto', 'matching', 'dice', 'euclidean',
-        # 'braycurtis', 'russellrao', 'cityblock', 'manhattan', 'infinity', 'jaccard', 'seuclidean', 'sokalsneath',
-        # 'kulsinski', 'minkowski', 'mahalanobis', 'p', 'l2', 'hamming', 'l1', 'wminkowski', 'pyfunc']
-        yaw_weight = 0.01*np.pi
-        metric_weights = np.array([1., 1., yaw_weight]) # TODO: wrap around and symmetry?
-        density = KernelDensity(bandwidth=self.bandwidth, algorithm='auto',
-                                kernel='gaussian', metric="wminkowski", atol=0, rtol=0,
-                                breadth_first=True, leaf_size=40,
-                                metric_params={'p': 2, 'w': metric_weights[:DIM]})
-        density.fit(X=points, sample_weight=1 * np.array(weights)) # Scaling doesn't seem to affect
-        self.density_from_surface[surface] = density
-        #scores = density.score_samples(points)
-        #probabilities = np.exp(-scores)
-        #print('Individual:', probabilities)
-        #print(np.sum(probabilities))
-        #total_score = density.score(points)
-        #total_probability = np.exp(-total_score)
-        #print('Total:', total_probability) # total log probability density
-        #print(total_probability)
+        density = KernelDensity(particles.values[mask, :DIM], weights=particles.weights[mask],
+                                bandwidth=self.bandwidth) # Scaling the weights doesn't affect the density
+        self.density_from_surface[surface] = (particles.version, density)
         # TODO: integrate to obtain a probability mass
-        # from scipy.stats.kde import gaussian_kde
-        # density = gaussian_kde(points, weights=weights) # No weights in my scipy version
         return density
-    def get_nearby(self, target_pose, radius=NEARBY_RADIUS):
+    def get_nearby_indices(self, target_pose, radius=NEARBY_RADIUS, draw=False):
+        target_point = np.array(point_from_pose(get_reference_from_body(target_pose)))
+        if draw:
+            draw_circle(target_point, radius, parent=target_pose.reference_body,
+                        parent_link=target_pose.reference_link)
+        return self.particles.get_nearby_indices(target_pose.support, target_point, radius)
+    def get_nearby_prob(self, target_pose, **kwargs):
+        # Neighborhood mass without creating the neighboring poses
+        indices = self.get_nearby_indices(target_pose, **kwargs)
+        return self.weight * np.sum(self.particles.weights[indices])
+    def get_nearby(self, target_pose, **kwargs):
         # TODO: could instead use the probability density
-        target_point = np.array(point_from_pose(target_pose.get_reference_from_body()))
-        draw_circle(target_point, radius, parent=target_pose.reference_body,
-                    parent_link=target_pose.reference_link)
-        poses = set()
-        for pose in self.dist.support():
-            if target_pose.support != pose.support:
-                continue
-            point = point_from_pose(pose.get_reference_from_body())
-            delta = target_point - point
-            if np.linalg.norm(delta[:2]) < radius:
-                poses.add(pose)
-        prob = sum(map(self.discrete_prob, poses))
+        indices = self.get_nearby_indices(target_pose, **kwargs)
+        poses = set(self.particles.get_poses(indices))
+        prob = self.weight * np.sum(self.particles.weights[indices])
         #poses = {target_pose}
         return Neighborhood(poses, prob)
 
-    def sample_surface_pose(self, surface): # TODO: timeout
+    def sample_surface_pose(self, surface, batch_size=SAMPLE_BATCH_SIZE,
+                            max_attempts=MAX_SAMPLE_ATTEMPTS, max_time=MAX_SAMPLE_TIME):
+        # Returns None if no supported pose is found within the attempt and time budgets
         density = self.get_density(surface)
         if density is None:
             return None
         assert surface is not None
+        start_time = time.time()
         body = self.world.get_body(self.name)
-        while True:
-            [sample] = density.sample(n_samples=1)
-            #[score] = density.score_samples([sample])
-            #prob = np.exp(-score)
-            pose = self.pose_from_pose2d(sample, surface)
-            pose.assign()
-            # TODO: additional obstacles
-            if test_supported(self.world, body, surface):
-                return pose # TODO: return prob?
+        surface_aabb = compute_surface_aabb(self.world, surface)
+        world_from_surface = get_surface_reference_pose(self.world.kitchen, surface)
+        surface_array = array_from_pose(world_from_surface)
+        lower, upper = np.array(surface_aabb.lower[:2]), np.array(surface_aabb.upper[:2])
+        attempts = 0
+        while (attempts < max_attempts) and (elapsed_time(start_time) < max_time):
+            samples = density.sample(n=min(batch_size, max_attempts - attempts))
+            attempts += len(samples)
+            #scores = density.log_prob(samples)
+            # The object's center must be above the surface for is_placed_on_aabb to hold
+            points = np.column_stack([samples[:, :2], np.zeros(len(samples))])
+            world_points = surface_array[:3] + rotate_points(surface_array[3:], points)
+            inside = np.all((lower <= world_points[:, :2]) & (world_points[:, :2] <= upper), axis=1)
+            for sample in samples[inside]:
+                pose = self.pose_from_pose2d(sample, surface, surface_aabb=surface_aabb,
+                                             world_from_surface=world_from_surface)
+                pose.assign()
+                # TODO: additional obstacles
+                if test_supported(self.world, body, surface):
+                    return pose # TODO: return prob?
+                if max_time <= elapsed_time(start_time):
+                    break
+        return None
     def sample_surface(self):
         return self.surface_dist.sample()
     def sample_discrete(self):
+        if self._particles is not None:
+            return self._particles.get_pose(self._particles.sample_index())
         return self.dist.sample()
     def sample(self):
         return self.sample_surface_pose(self.sample_surface())
@@ -163,9 +229,24 @@ class PoseDist(object):
             return self
         with LockRenderer():
             poses = [self.sample() for _ in range(n)]
+        poses = [pose for pose in poses if pose is not None]
+        if not poses:
+            return self
         new_dist = UniformDist(poses)
         return self.__class__(self.world, self.name, new_dist)
+    def resample_adaptive(self, min_particles=MIN_PARTICLES, max_particles=NUM_PARTICLES):
+        # The particle count grows with the number of bins the posterior occupies
+        if self.is_localized():
+            return self
+        particles = self.particles
+        num_bins = particles.count_bins(KLD_BIN_SIZES, min_mass=1. / max_particles)
+        n = kld_particle_count(num_bins, epsilon=KLD_EPSILON, delta=KLD_DELTA)
+        n = int(np.clip(n, min_particles, max_particles))
+        return self.__class__(self.world, self.name, particles.resample(n, pos_std=self.bandwidth),
+                              bandwidth=self.bandwidth)
     def copy(self):
+        if self._particles is not None:
+            return self.__class__(self.world, self.name, self._particles.copy())
         return self.__class__(self.world, self.name, self.dist.copy())
 
     def decompose(self):
@@ -177,7 +258,19 @@ class PoseDist(object):
             weight = self.surface_prob(surface_name)
             pose_dists.append(SurfaceDist(self, weight, dist))
         return pose_dists
-    def update_dist(self, observation, obstacles=[], verbose=False):
+    def is_occlusion_independent(self, observation):
+        # Whether update_dist ignores the other objects
+        return (not BAYESIAN and (self.name in observation)) or not self.world.cameras
+    def get_detectable(self, views):
+        # Detectability only depends on the camera frusta (not the occluders)
+        # Returns the poses within any frustum, their world points, and the (C, N) per-camera frustum masks
+        particles = self.particles
+        world_points = particles.get_world_points()
+        masks = get_visible_masks(world_points, views)
+        [indices] = np.nonzero(np.any(masks, axis=0))
+        return particles.get_poses(indices), world_points[indices], masks[:, indices]
+    def update_dist(self, observation, obstacles=[], verbose=False, visible_poses=None):
+        # visible_poses may be precomputed (e.g. by a worker process)
         # cfree_dist.conditionOnVar(index=1, has_detection=True)
         if not BAYESIAN and (self.name in observation):
             # TODO: convert into a Multivariate Gaussian
@@ -186,26 +279,23 @@ class PoseDist(object):
         if not self.world.cameras:
             return self.dist.copy()
         body = self.world.get_body(self.name)
-        all_poses = self.dist.support()
-        cfree_poses = all_poses
-        #cfree_poses = compute_cfree(body, all_poses, obstacles)
-        #cfree_dist = self.cfree_dist
-        cfree_dist = DDist({pose: self.dist.prob(pose) for pose in cfree_poses})
-        # TODO: do these updates simultaneously for each object
-        # TODO: check all camera poses
-        [camera] = self.world.cameras.keys()
-        info = self.world.cameras[camera]
-        camera_pose = get_pose(info.body)
-        detectable_poses = compute_detectable(cfree_poses, camera_pose)
-        visible_poses = compute_visible(body, detectable_poses, camera_pose, draw=False)
+        particles = self.particles
+        #cfree_poses = compute_cfree(body, particles.get_poses(), obstacles)
+        if visible_poses is None:
+            views = get_camera_views(self.world)
+            detectable_poses, detectable_points, masks = self.get_detectable(views)
+            visible_poses = compute_visible(body, detectable_poses, [view.pose for view in views], draw=False,
+                                            points=dict(zip(detectable_poses, detectable_points)), masks=masks,
+                                            ray_collision_fn=get_ray_collision_fn(self.world))
+        visible = np.zeros(len(particles), dtype=bool)
+        visible[np.array([particles.get_index(pose) for pose in visible_poses], dtype=int)] = True
         if verbose:
-            print('Total: {} | CFree: {} | Detectable: {} | Visible: {}'.format(
-                len(all_poses), len(cfree_poses), len(detectable_poses), len(visible_poses)))
-        assert set(visible_poses) <= set(detectable_poses)
+            print('Total: {} | Visible: {}'.format(len(particles), len(visible_poses)))
         # obs_fn = get_observation_fn(surface)
         #wait_for_user()
-        return self.bayesian_belief_update(cfree_dist, visible_poses, observation, verbose=verbose)
-    def bayesian_belief_update(self, prior_dist, visible_poses, observation, verbose=False):
+        return self.bayesian_belief_update(particles, visible, observation, verbose=verbose)
+    def bayesian_belief_update(self, particles, visible, observation, verbose=False):
+        # Returns a copy of the particles reweighted by the detection and registration likelihoods
         has_detection = self.name in observation
         detected_surface = None
         pose_estimate_2d = None
@@ -214,43 +304,50 @@ class PoseDist(object):
             detected_surface = detected_pose.support
             pose_estimate_2d = self.pose2d_from_pose(detected_pose)
         else:
-            for pose in visible_poses:
+            for pose in particles.get_poses(np.nonzero(visible)[0]):
                 pose.observations += 1
         if verbose:
             print('Detection: {} | Pose: {}'.format(has_detection, pose_estimate_2d))
         # TODO: could use an UKF to propagate a GMM
-        new_dist = prior_dist.copy()
-        # cfree_dist.obsUpdate(detection_fn, has_detection)
-        new_dist.obsUpdates([
-            get_detection_fn(visible_poses),
-            get_registration_fn(visible_poses),
-            # ], [has_detection, pose_estimate_2d])
-        ], [detected_surface, pose_estimate_2d])
-        # cfree_dist = bayesEvidence(cfree_dist, detection_fn, has_detection) # projects out b and computes joint
-        # joint_dist = JDist(cfree_dist, detection_fn, registration_fn)
-        return new_dist
-    def update(self, belief, observation, n_samples=25, verbose=False, **kwargs):
-        if verbose:
-            print('Prior:', self.dist)
-        body = self.world.get_body(self.name)
-        obstacles = [self.world.get_body(name) for name in belief.pose_dists if name != self.name]
-        dists = []
-        for _ in range(n_samples):
-            belief.sample(discrete=True)  # Trouble if no support
-            with BodySaver(body):
-                new_dist = self.update_dist(observation, obstacles, **kwargs)
-                #new_pose_dist = self.__class__(self.world, self.name, new_dist).resample()
-            dists.append(new_dist)
-            #remove_all_debug()
-            #new_pose_dist.draw(color=belief.color_from_name[self.name])
-            #wait_for_user()
-        posterior = mixDDists({dist: 1./len(dists) for dist in dists})
+        log_likelihoods = get_detection_log_likelihoods(particles, visible, detected_surface)
+        if has_detection:
+            log_likelihoods += get_registration_log_likelihoods(particles, pose_estimate_2d)
+        log_weights = particles.log_weights + log_likelihoods
+        new_particles = particles.copy()
+        if np.isfinite(logsumexp(log_weights)):
+            new_particles.set_log_weights(log_weights)
+        else:
+            print('Warning! Observation has zero probability for {}'.format(self.name))
+        return new_particles
+    def mix_posteriors(self, dists, verbose=False):
+        # dists maps posterior DDists (or reweighted copies of the particles) to their probabilities
+        if all(isinstance(dist, Particles) for dist in dists):
+            # The posteriors share the prior's particles, so their weights can be mixed directly
+            posterior = self.particles.copy()
+            posterior.set_log_weights(logsumexp([np.log(prob) + dist.log_weights
+                                                 for dist, prob in dists.items()], axis=0))
+            posterior = posterior.prune(PRUNE_PROB).compact(MERGE_BIN_SIZES, max_particles=MAX_SUPPORT)
+        else:
+            posterior = mixDDists({dist.to_dist() if isinstance(dist, Particles) else dist: prob
+                                   for dist, prob in dists.items()})
         if verbose:
             print('Posterior:', posterior)
         pose_dist = self.__class__(self.world, self.name, posterior)
         if RESAMPLE:
-            pose_dist = pose_dist.resample()
+            pose_dist = pose_dist.resample_adaptive() if ADAPTIVE_RESAMPLE else pose_dist.resample()
         return pose_dist
+    def update(self, belief, observation, n_samples=25, pool=None, verbose=False, **kwargs):
+        if verbose:
+            print('Prior:', self.dist)
+        if not self.is_occlusion_independent(observation):
+            [pose_dist] = update_occluded_dists(belief, [self.name], observation, n_samples=n_samples,
+                                                pool=pool, verbose=verbose).values()
+            return pose_dist
+        body = self.world.get_body(self.name)
+        obstacles = [self.world.get_body(name) for name in belief.pose_dists if name != self.name]
+        with BodySaver(body):
+            new_dist = self.update_dist(observation, obstacles, **kwargs)
+        return self.mix_posteriors({new_dist: 1.}, verbose=verbose)
 
     def dump(self):
         print(self.name, self.dist)
@@ -296,32 +393,130 @@ class SurfaceDist(PoseDist):
 
 ################################################################################
 
-def compute_detectable(poses, camera_pose):
-    detectable_poses = set()
-    for pose in poses:
-        point = point_from_pose(pose.get_world_from_body())
-        if is_visible_point(CAMERA_MATRIX, KINECT_DEPTH, point, camera_pose=camera_pose):
-            detectable_poses.add(pose)
-    return detectable_poses
+def sample_occluder_configurations(belief, name, n_samples):
+    # Groups the sampled states by the poses of the other objects, which are what can occlude name
+    # If name is None, the states are grouped by the poses of every object
+    # Returns a list of (sampled poses, number of samples) in the order first sampled
+    keys = []
+    poses_from_key = {}
+    count_from_key = {}
+    for _ in range(n_samples):
+        poses = belief.sample(discrete=True)
+        if poses is None:
+            continue
+        key = frozenset((other, pose) for other, pose in poses.items() if other != name)
+        if key not in count_from_key:
+            keys.append(key)
+            poses_from_key[key] = poses
+            count_from_key[key] = 0
+        count_from_key[key] += 1
+    if not keys:
+        # Falls back on the current poses if no collision-free state was sampled
+        return [({}, n_samples)]
+    return [(poses_from_key[key], count_from_key[key]) for key in keys]
+
+def get_detectables(belief, names, views=None):
+    # Maps each name to its detectable poses, points, and frustum masks (see PoseDist.get_detectable)
+    if views is None:
+        views = get_camera_views(belief.world)
+    return {name: belief.pose_dists[name].get_detectable(views) for name in names}
 
+def update_occluded_dists(belief, names, observation, n_samples=25, pool=None, detectables=None, verbose=False):
+    # Updates objects whose visibility depends on the other objects using shared world samples
+    # Each sampled world ray traces every object from every camera in a single batch_ray_collision
+    # detectables may be precomputed (e.g. by get_observable) as the particles and cameras are unchanged
+    # TODO: objects are updated simultaneously, so their occluders are sampled from the prior beliefs
+    world = belief.world
+    views = get_camera_views(world)
+    camera_points = [point_from_pose(view.pose) for view in views]
+    if detectables is None:
+        detectables = get_detectables(belief, names, views)
+    detectables = [detectables[name] for name in names]
+    configurations = sample_occluder_configurations(belief, None, n_samples)
+    num_samples = sum(count for _, count in configurations)
+    if pool is None:
+        queries = [(world.get_body(name), points, masks) for name, (_, points, masks) in zip(names, detectables)]
+        visible_masks = []
+        for poses, _ in configurations:
+            for pose in poses.values():
+                pose.assign()
+            visible_masks.append(compute_occlusion_masks(queries, camera_points,
+                                                         ray_collision_fn=get_ray_collision_fn(world)))
+    else:
+        # Each task ray traces a group of objects in one configuration
+        # Objects are split into groups when there are fewer configurations than workers
+        queries = [(name, points, masks) for name, (_, points, masks) in zip(names, detectables)]
+        num_groups = min(len(queries), int(math.ceil(float(pool.processes) / len(configurations))))
+        groups = [list(group) for group in np.array_split(np.arange(len(queries)), num_groups)]
+        tasks = []
+        for poses, _ in configurations:
+            for pose in poses.values():
+                pose.assign()
+            state = get_world_state(world)
+            tasks.extend((state, camera_points, [queries[i] for i in group]) for group in groups)
+        results = pool.map(compute_visible_masks, tasks)
+        # Results are in task order, so merging them is deterministic
+        visible_masks = [[masks for group_masks in results[k*len(groups):(k+1)*len(groups)] for masks in group_masks]
+                         for k in range(len(configurations))]
+    if verbose:
+        print('Samples: {} | Configurations: {} | Objects: {} | Cameras: {}'.format(
+            n_samples, len(configurations), len(names), len(views)))
+    pose_dists = {}
+    for i, name in enumerate(names):
+        pose_dist = belief.pose_dists[name]
+        detectable_poses = detectables[i][0]
+        # Configurations that agree on the visible poses produce the same posterior
+        count_from_visible = {}
+        for (_, count), masks in zip(configurations, visible_masks):
+            key = tuple(np.nonzero(masks[i])[0])
+            count_from_visible[key] = count_from_visible.get(key, 0) + count
+        dists = {}
+        for key, count in count_from_visible.items():
+            visible_poses = {detectable_poses[index] for index in key}
+            new_dist = pose_dist.update_dist(observation, visible_poses=visible_poses)
+            dists[new_dist] = float(count) / num_samples
+        pose_dists[name] = pose_dist.mix_posteriors(dists, verbose=verbose)
+    return pose_dists
 
-def compute_visible(body, poses, camera_pose, draw=True):
+def get_observable(belief, names, detectables=None):
+    # The objects with particles that could be visible for some placement of the other objects
+    # Rays that first hit a fixed body (e.g. the kitchen or robot) are blocked in every sampled configuration
+    # Updating the remaining objects would not change their beliefs
+    world = belief.world
+    views = get_camera_views(world)
+    camera_points = [point_from_pose(view.pose) for view in views]
+    if detectables is None:
+        detectables = get_detectables(belief, names, views)
+    queries = []
+    for name in names:
+        _, points, masks = detectables[name]
+        queries.append((world.get_body(name), points, masks))
+    movable = {world.get_body(name) for name in world.movable}
+    visible_masks = compute_occlusion_masks(queries, camera_points, ray_collision_fn=get_ray_collision_fn(world),
+                                            transparent=movable)
+    return [name for name, visible in zip(names, visible_masks) if np.any(visible)]
+
+def compute_visible(body, poses, camera_poses, draw=True, points={}, masks=None,
+                    ray_collision_fn=batch_ray_collision):
+    # points optionally maps poses to their precomputed world points
+    # masks[c, i] optionally specifies whether the ith pose is within the frustum of camera c
     ordered_poses = list(poses)
-    rays = []
-    camera_point = point_from_pose(camera_pose)
-    for pose in ordered_poses:
-        point = point_from_pose(pose.get_world_from_body())
-        rays.append(Ray(camera_point, point))
-    ray_results = batch_ray_collision(rays)
+    world_points = [points[pose] if pose in points else point_from_pose(pose.get_world_from_body())
+                    for pose in ordered_poses]
+    if masks is None:
+        masks = np.ones((len(camera_poses), len(ordered_poses)), dtype=bool)
+    camera_points = [point_from_pose(camera_pose) for camera_pose in camera_poses]
     if draw:
+        rays, _ = get_camera_rays(camera_points, world_points, masks)
         with LockRenderer():
             handles = []
-            for ray, result in zip(rays, ray_results):
+            for ray, result in zip(rays, ray_collision_fn(rays)):
                 handles.extend(draw_ray(ray, result))
     # Blocking objects will likely be known with high probability
     # TODO: move objects out of the way?
-    return {pose for pose, result in zip(ordered_poses, ray_results)
-            if result.objectUniqueId in (body, -1)}
+    [visible] = compute_occlusion_masks([(body, world_points, masks)], camera_points,
+                                        ray_collision_fn=ray_collision_fn)
+    return {pose for pose, is_visible in zip(ordered_poses, visible) if is_visible}
 
 
 def compute_cfree(body, poses, obstacles=[]):
@@ -359,6 +554,35 @@ class SE2Distribution(Distribution):
 # no detection, detection at point, detection elsewhere
 # The two observation functions mimic how the examples are generated
 
+def get_detection_log_likelihoods(particles, visible, detected_surface, p_fp=MODEL_P_FP, p_fn=MODEL_P_FN):
+    # Vectorized get_detection_fn: log P(detected surface | particle) for each particle
+    assert p_fp == 0
+    log_likelihoods = np.full(len(particles), -np.inf)
+    with np.errstate(divide='ignore'):
+        if detected_surface is None:
+            log_likelihoods[~visible] = 0.
+            log_likelihoods[visible] = np.log(p_fn)
+        else:
+            log_likelihoods[visible & particles.get_surface_mask(detected_surface)] = np.log(1. - p_fn)
+    return log_likelihoods
+
+def get_gaussian_log_densities(deltas, std):
+    return -np.square(deltas / std) / 2. - np.log(np.sqrt(2*np.pi)*std)
+
+def get_registration_log_likelihoods(particles, pose_estimate_2d, pos_std=MODEL_POS_STD, ori_std=MODEL_ORI_STD):
+    # Vectorized get_registration_fn: log P(pose estimate | particle, detection) for each particle
+    deltas = np.array(pose_estimate_2d[:2]) - particles.values[:, :2]
+    log_likelihoods = np.sum(get_gaussian_log_densities(deltas, pos_std), axis=1)
+    if DIM == 3:
+        # Same as SE2Distribution, whose truncnorm bounds are in units of ori_std
+        bound = np.pi
+        yaw_deltas = wrap_angles(pose_estimate_2d[2] - particles.values[:, 2])
+        yaw_log_likelihoods = get_gaussian_log_densities(yaw_deltas, ori_std) - \
+                              np.log(norm.cdf(bound) - norm.cdf(-bound))
+        yaw_log_likelihoods[bound < np.abs(yaw_deltas / ori_std)] = -np.inf
+        log_likelihoods += yaw_log_likelihoods
+    return log_likelihoods
+
 def get_detection_fn(visible, p_fp=MODEL_P_FP, p_fn=MODEL_P_FN):
     # TODO: precompute visible here
     # TODO: mixture over ALL_SURFACES
@@ -4,10 +4,10 @@ import math
 import numpy as np
 import random
 
-from pybullet_tools.pr2_utils import is_visible_point
 from pybullet_tools.utils import get_pose, point_from_pose, Ray, batch_ray_collision, has_gui, add_line, BLUE, \
     wait_for_duration, remove_handles, Pose, Point, Euler, multiply, set_pose, aabb_contains_point, tform_point, angle_between
 from src.utils import CAMERA_MATRIX, KINECT_DEPTH, create_relative_pose, create_world_pose
+from src.visibility import CameraView, get_visible_masks
 
 OBS_P_FP, OBS_P_FN = 0.0, 0.0
 #OBS_POS_STD, OBS_ORI_STD = 0.01, np.pi / 8
@@ -20,14 +20,15 @@ ELSEWHERE = None # symbol for elsewhere pose
 def are_visible(world):
     ray_names = []
     rays = []
-    for name in world.movable:
-        for camera, info in world.cameras.items():
-            camera_pose = get_pose(info.body)
-            camera_point = point_from_pose(camera_pose)
-            point = point_from_pose(get_pose(world.get_body(name)))
-            if is_visible_point(CAMERA_MATRIX, KINECT_DEPTH, point, camera_pose=camera_pose):
+    names = list(world.movable)
+    points = np.array([point_from_pose(get_pose(world.get_body(name))) for name in names]).reshape(-1, 3)
+    views = [CameraView(get_pose(info.body), CAMERA_MATRIX, KINECT_DEPTH) for info in world.cameras.values()]
+    masks = get_visible_masks(points, views)
+    for i, name in enumerate(names):
+        for j, view in enumerate(views):
+            if masks[j, i]:
                 ray_names.append(name)
-                rays.append(Ray(camera_point, point))
+                rays.append(Ray(point_from_pose(view.pose), points[i]))
     ray_results = batch_ray_collision(rays)
     visible_indices = [idx for idx, (name, result) in enumerate(zip(ray_names, ray_results))
                        if result.objectUniqueId == world.get_body(name)]
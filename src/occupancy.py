@@ -0,0 +1,49 @@
+import numpy as np
+
+# Occupancy bitmaps that replace repeated point-in-polygon tests with a single array lookup
+
+GRID_RESOLUTION = 0.01 # meters per cell
+
+def get_inside_convex_polygon(points, vertices):
+    # Vectorized pybullet_tools.utils.is_point_in_polygon for (N, 2) points
+    points = np.atleast_2d(points)[:, :2]
+    vertices = np.array(vertices, dtype=float)[:, :2]
+    edges = np.roll(vertices, -1, axis=0) - vertices
+    offsets = points[:, np.newaxis, :] - vertices[np.newaxis, :, :]
+    crosses = edges[np.newaxis, :, 0]*offsets[..., 1] - edges[np.newaxis, :, 1]*offsets[..., 0]
+    return np.all(0 <= crosses, axis=1) | np.all(crosses <= 0, axis=1)
+
+class OccupancyGrid(object):
+    def __init__(self, occupied, lower, resolution=GRID_RESOLUTION):
+        self.occupied = np.array(occupied, dtype=bool)
+        self.lower = np.array(lower, dtype=float)
+        self.resolution = float(resolution)
+    @classmethod
+    def from_polygon(cls, vertices, resolution=GRID_RESOLUTION):
+        # A cell is occupied when its center is within the polygon
+        if len(vertices) < 3:
+            return cls(np.zeros((0, 0)), np.zeros(2), resolution)
+        vertices = np.array(vertices, dtype=float)[:, :2]
+        lower = np.min(vertices, axis=0)
+        shape = np.ceil((np.max(vertices, axis=0) - lower) / resolution).astype(int) + 1
+        xs, ys = [lower[i] + resolution*(np.arange(shape[i]) + 0.5) for i in range(2)]
+        centers = np.column_stack([coords.flatten() for coords in np.meshgrid(xs, ys, indexing='ij')])
+        occupied = get_inside_convex_polygon(centers, vertices).reshape(shape)
+        return cls(occupied, lower, resolution)
+    def contains_points(self, points):
+        points = np.atleast_2d(points)[:, :2]
+        indices = np.floor((points - self.lower) / self.resolution).astype(int)
+        valid = np.all((0 <= indices) & (indices < self.occupied.shape), axis=1)
+        contained = np.zeros(len(points), dtype=bool)
+        contained[valid] = self.occupied[indices[valid, 0], indices[valid, 1]]
+        return contained
+    def contains(self, point):
+        i, j = np.floor((np.array(point[:2]) - self.lower) / self.resolution).astype(int)
+        if not ((0 <= i < self.occupied.shape[0]) and (0 <= j < self.occupied.shape[1])):
+            return False
+        return bool(self.occupied[i, j])
+    def __len__(self):
+        return int(np.sum(self.occupied))
+    def __repr__(self):
+        return '{}({}x{}, {})'.format(self.__class__.__name__, self.occupied.shape[0],
+                                      self.occupied.shape[1], len(self))
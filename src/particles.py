@@ -0,0 +1,279 @@
+from __future__ import print_function
+
+import numpy as np
+
+from scipy.spatial import cKDTree
+from scipy.special import logsumexp
+from scipy.stats import norm
+
+from examples.discrete_belief.dist import DDist
+from pybullet_tools.utils import Attachment, BASE_LINK, Pose, Point, Euler, base_values_from_pose, link_from_name, \
+    get_link_pose, stable_z_on_aabb, point_from_pose, unit_pose
+from src.poses import array_from_pose, rotate_points
+from src.utils import RelPose, ENV_SURFACES, Z_EPSILON, surface_from_name, compute_surface_aabb
+
+# Particles are stored as arrays of surface-relative (x, y, yaw) values
+# RelPose objects are only created when a particle is handed to the planner
+# Weights are maintained as normalized log-weights to avoid underflow after repeated updates
+
+def get_surface_reference(world, surface_name):
+    # The body and link that surface-relative poses are attached to (see create_surface_attachment)
+    if surface_name in ENV_SURFACES:
+        return world.environment_bodies[surface_name], BASE_LINK
+    surface = surface_from_name(surface_name)
+    return world.kitchen, link_from_name(world.kitchen, surface.link)
+
+def get_world_from_reference(reference_body, reference_link):
+    # Same as RelPose.get_world_from_reference without assigning the pose
+    if reference_body is None:
+        return unit_pose()
+    return get_link_pose(reference_body, reference_link)
+
+def get_reference_from_body(pose):
+    # Reads the attachment transform directly to avoid assigning the pose in the simulator
+    if (len(pose.confs) == 1) and isinstance(pose.confs[0], Attachment):
+        [attachment] = pose.confs
+        if (attachment.parent == pose.reference_body) and (attachment.child == pose.body):
+            return attachment.grasp_pose
+    return pose.get_reference_from_body()
+
+def values_from_pose(pose):
+    return np.array(base_values_from_pose(get_reference_from_body(pose)))
+
+def systematic_resample(weights, n):
+    # Low-variance resampling: a single random offset followed by n evenly spaced pointers
+    cumulative = np.cumsum(weights) / np.sum(weights)
+    cumulative[-1] = 1.
+    pointers = (np.random.uniform() + np.arange(n)) / n
+    return np.searchsorted(cumulative, pointers)
+
+def kld_particle_count(num_bins, epsilon=0.05, delta=0.01):
+    # Number of samples such that the KL divergence to the binned distribution is below epsilon w.p. 1 - delta
+    # Fox, KLD-Sampling: Adaptive Particle Filters (2001)
+    if num_bins <= 1:
+        return 1
+    z = norm.ppf(1 - delta)
+    a = 2. / (9*(num_bins - 1))
+    return int(np.ceil((num_bins - 1) / (2*epsilon) * np.power(1 - a + np.sqrt(a)*z, 3)))
+
+def normalize_log_weights(log_weights):
+    log_weights = np.array(log_weights, dtype=float)
+    normalizer = logsumexp(log_weights) if len(log_weights) else -np.inf
+    if not np.isfinite(normalizer):
+        raise ValueError('Weights cannot be normalized: {}'.format(normalizer))
+    return log_weights - normalizer
+
+class Particles(object):
+    def __init__(self, world, name, surfaces, values, weights, surface_indices,
+                 poses=None, observations=None, heights={}, log_weights=None, references=None):
+        # Either weights or log_weights may be provided (and need not be normalized)
+        self.world = world
+        self.name = name
+        self.surfaces = list(surfaces) # Surface name for each surface index
+        if references is None:
+            references = [get_surface_reference(world, surface) for surface in self.surfaces]
+        self.references = list(references) # (reference_body, reference_link) for each surface index
+        self.values = np.array(values, dtype=float).reshape(-1, 3) # x, y, yaw
+        if log_weights is None:
+            with np.errstate(divide='ignore'):
+                log_weights = np.log(np.array(weights, dtype=float))
+        self.log_weights = normalize_log_weights(log_weights)
+        self.weights = np.exp(self.log_weights)
+        self.surface_indices = np.array(surface_indices, dtype=int)
+        self.poses = list(poses) if poses is not None else [None]*len(self.values)
+        self.observations = np.zeros(len(self.values), dtype=int) if observations is None else \
+            np.array(observations, dtype=int)
+        self.heights = dict(heights) # Object height relative to the reference frame of each surface
+        self.index_from_pose = {pose: index for index, pose in enumerate(self.poses) if pose is not None}
+        self.version = 0 # Incremented whenever the particles are modified in place
+        self.trees = {} # Lazily built per-surface indices over particle positions (positions are immutable)
+        assert len(self.values) == len(self.weights) == len(self.surface_indices) == len(self.poses)
+        assert len(self.surfaces) == len(self.references)
+    @classmethod
+    def from_dist(cls, world, name, dist):
+        poses = list(dist.support())
+        surfaces = []
+        references = []
+        surface_indices = []
+        heights = {}
+        for pose in poses:
+            # World poses (support=None) are not attached to a surface (see create_world_pose)
+            if pose.support not in surfaces:
+                surfaces.append(pose.support)
+                references.append((pose.reference_body, pose.reference_link))
+                heights[pose.support] = point_from_pose(get_reference_from_body(pose))[2]
+            surface_indices.append(surfaces.index(pose.support))
+        values = [values_from_pose(pose) for pose in poses]
+        weights = [dist.prob(pose) for pose in poses]
+        observations = [pose.observations for pose in poses]
+        return cls(world, name, surfaces, values, weights, surface_indices,
+                   poses=poses, observations=observations, heights=heights, references=references)
+    def __len__(self):
+        return len(self.values)
+    @property
+    def total(self):
+        return np.sum(self.weights)
+
+    def get_surface_index(self, surface_name):
+        if surface_name not in self.surfaces:
+            return None
+        return self.surfaces.index(surface_name)
+    def get_reference(self, surface_name):
+        surface_index = self.get_surface_index(surface_name)
+        if surface_index is None:
+            return get_surface_reference(self.world, surface_name)
+        return self.references[surface_index]
+    def get_surface_mask(self, surface_name):
+        surface_index = self.get_surface_index(surface_name)
+        if surface_index is None:
+            return np.zeros(len(self), dtype=bool)
+        return self.surface_indices == surface_index
+    def get_surface_weights(self):
+        return np.bincount(self.surface_indices, weights=self.weights, minlength=len(self.surfaces))
+    def get_height(self, surface_name):
+        if surface_name not in self.heights:
+            # Same as PoseDist.pose_from_pose2d
+            body = self.world.get_body(self.name)
+            surface_aabb = compute_surface_aabb(self.world, surface_name)
+            world_from_reference = get_world_from_reference(*self.get_reference(surface_name))
+            self.heights[surface_name] = stable_z_on_aabb(body, surface_aabb) + Z_EPSILON - \
+                                         point_from_pose(world_from_reference)[2]
+        return self.heights[surface_name]
+    def get_reference_points(self):
+        # (N, 3) positions relative to each particle's surface reference frame
+        heights = np.array([self.get_height(surface) for surface in self.surfaces])
+        if not len(heights):
+            return np.zeros((0, 3))
+        return np.column_stack([self.values[:, :2], heights[self.surface_indices]])
+    def get_world_points(self):
+        # Queries the simulator once per surface rather than once per particle
+        points = self.get_reference_points()
+        world_points = np.zeros(points.shape)
+        for surface_index, reference in enumerate(self.references):
+            mask = (self.surface_indices == surface_index)
+            reference_pose = array_from_pose(get_world_from_reference(*reference))
+            world_points[mask] = reference_pose[:3] + rotate_points(reference_pose[3:], points[mask])
+        return world_points
+
+    def get_tree(self, surface_index):
+        if surface_index not in self.trees:
+            [indices] = np.nonzero(self.surface_indices == surface_index)
+            self.trees[surface_index] = (indices, cKDTree(self.values[indices, :2]))
+        return self.trees[surface_index]
+    def get_nearby_indices(self, surface_name, point, radius):
+        # Particles on surface_name within radius of the surface-relative point
+        surface_index = self.get_surface_index(surface_name)
+        if surface_index is None:
+            return np.zeros(0, dtype=int)
+        indices, tree = self.get_tree(surface_index)
+        return indices[np.array(tree.query_ball_point(point[:2], radius), dtype=int)]
+
+    def get_pose(self, index):
+        if self.poses[index] is None:
+            surface_index = self.surface_indices[index]
+            surface_name = self.surfaces[surface_index]
+            x, y, yaw = self.values[index]
+            reference_body, reference_link = self.references[surface_index]
+            reference_from_body = Pose(Point(x, y, self.get_height(surface_name)), Euler(yaw=yaw))
+            body = self.world.get_body(self.name)
+            attachment = Attachment(reference_body, reference_link, reference_from_body, body)
+            pose = RelPose(body, reference_body=reference_body, reference_link=reference_link,
+                           confs=[attachment], support=surface_name)
+            pose.observations = int(self.observations[index])
+            self.poses[index] = pose
+            self.index_from_pose[pose] = index
+        return self.poses[index]
+    def get_poses(self, indices=None):
+        if indices is None:
+            indices = range(len(self))
+        return [self.get_pose(index) for index in indices]
+    def get_observations(self):
+        # Detections may have been counted on the materialized poses
+        return np.array([self.observations[index] if pose is None else pose.observations
+                         for index, pose in enumerate(self.poses)], dtype=int)
+    def get_index(self, pose):
+        return self.index_from_pose.get(pose, None)
+    def prob(self, pose):
+        index = self.get_index(pose)
+        if index is None:
+            return 0.
+        return self.weights[index]
+    def set_log_weights(self, log_weights):
+        self.log_weights = normalize_log_weights(log_weights)
+        self.weights = np.exp(self.log_weights)
+        assert len(self.weights) == len(self)
+        self.version += 1
+    def set_weights(self, weights):
+        with np.errstate(divide='ignore'):
+            self.set_log_weights(np.log(np.array(weights, dtype=float)))
+    def sample_index(self):
+        return np.random.choice(len(self), p=self.weights / self.total)
+
+    def get_bins(self, bin_sizes):
+        # Index of the (surface, x, y[, yaw]) bin containing each particle
+        dim = len(bin_sizes)
+        bins = np.column_stack([self.surface_indices, np.floor(self.values[:, :dim] / bin_sizes).astype(int)])
+        _, inverse = np.unique(bins, axis=0, return_inverse=True)
+        return inverse.flatten()
+    def count_bins(self, bin_sizes, min_mass=0.):
+        # Number of bins containing more than min_mass of the probability
+        if not len(self):
+            return 0
+        masses = np.bincount(self.get_bins(bin_sizes), weights=self.weights / self.total)
+        return int(np.sum(min_mass < masses))
+    def compact(self, bin_sizes, max_particles=np.inf):
+        # Merges the particles within each bin into its most likely particle, which receives their summed weight
+        # Then keeps (at most) the max_particles most likely particles
+        if len(self) <= 1:
+            return self
+        bins = self.get_bins(bin_sizes)
+        order = np.argsort(-self.log_weights, kind='mergesort')
+        _, first = np.unique(bins[order], return_index=True)
+        indices = order[first] # Indexed by bin
+        if len(indices) == 1:
+            # Merging into a single particle would localize the belief (see delocalize_belief)
+            # Instead, keeps the two most likely particles
+            indices = order[:2]
+            log_weights = self.log_weights[indices]
+        else:
+            log_weights = np.full(len(indices), -np.inf)
+            np.logaddexp.at(log_weights, bins, self.log_weights)
+        if max_particles < len(indices):
+            best = np.argsort(-log_weights, kind='mergesort')[:int(max_particles)]
+            indices, log_weights = indices[best], log_weights[best]
+        if len(indices) == len(self):
+            return self
+        return self.__class__(self.world, self.name, self.surfaces, self.values[indices], None,
+                              self.surface_indices[indices], poses=[self.poses[index] for index in indices],
+                              observations=self.observations[indices], heights=self.heights,
+                              references=self.references,
+                              log_weights=log_weights)
+    def resample(self, n, pos_std=0.):
+        # Systematically resamples n new (unmaterialized) particles with uniform weights
+        indices = systematic_resample(self.weights, n)
+        values = self.values[indices]
+        values[:, :2] += np.random.normal(scale=pos_std, size=(n, 2))
+        return self.__class__(self.world, self.name, self.surfaces, values, np.ones(n) / n,
+                              self.surface_indices[indices], heights=self.heights, references=self.references)
+
+    def subset(self, indices):
+        # The weights of the subset are renormalized
+        indices = np.arange(len(self))[indices]
+        return self.__class__(self.world, self.name, self.surfaces, self.values[indices], None,
+                              self.surface_indices[indices], poses=[self.poses[index] for index in indices],
+                              observations=self.observations[indices], heights=self.heights,
+                              references=self.references,
+                              log_weights=self.log_weights[indices])
+    def prune(self, min_prob):
+        # Removes particles with less than min_prob probability (always keeping the most likely one)
+        mask = (np.log(min_prob) <= self.log_weights)
+        mask[np.argmax(self.log_weights)] = True
+        if np.all(mask):
+            return self
+        return self.subset(mask)
+    def copy(self):
+        return self.subset(np.arange(len(self)))
+    def to_dist(self):
+        return DDist({pose: weight for pose, weight in zip(self.get_poses(), self.weights)})
+    def __repr__(self):
+        return '{}({}, {}, {})'.format(self.__class__.__name__, self.name, self.surfaces, len(self))
@@ -39,7 +39,7 @@ def opt_detect_cost_fn(obj_name, rp_dist, obs, rp_sample):
     if isinstance(rp_sample, RelPose) or (rp_dist == rp_sample):
         # This shouldn't be needed if eager=True
         return detect_cost_fn(obj_name, rp_dist, obs, rp_sample)
-    prob = rp_dist.surface_prob(rp_dist.surface_name)
+    [prob] = rp_dist.surface_probs([rp_dist.surface_name])
     #print(rp_dist.surface_name, prob)
     cost = clip_cost(compute_detect_cost(prob))
     print('{}) Opt Detect Prob: {:.3f} | Opt Detect Cost: {:.3f} | Type: {}'.format(
@@ -0,0 +1,64 @@
+import numpy as np
+
+# Batch SE(3) operations on (N, 7) arrays of [x, y, z, qx, qy, qz, qw] (pybullet quaternion order)
+# Each function also accepts a single (7,) pose, which broadcasts against a batch
+
+POSE_LENGTH = 7 # point + quat
+
+def array_from_pose(pose):
+    point, quat = pose
+    return np.concatenate([point, quat])
+
+def pose_from_array(array):
+    return tuple(map(float, array[:3])), tuple(map(float, array[3:POSE_LENGTH]))
+
+def array_from_poses(poses):
+    if not poses:
+        return np.zeros((0, POSE_LENGTH))
+    return np.array([array_from_pose(pose) for pose in poses], dtype=float)
+
+def poses_from_array(array):
+    return [pose_from_array(row) for row in np.atleast_2d(array)]
+
+################################################################################
+
+def multiply_quats(quats1, quats2):
+    vectors1, scalars1 = quats1[..., :3], quats1[..., 3:]
+    vectors2, scalars2 = quats2[..., :3], quats2[..., 3:]
+    vectors = scalars1*vectors2 + scalars2*vectors1 + np.cross(vectors1, vectors2)
+    scalars = scalars1*scalars2 - np.sum(vectors1*vectors2, axis=-1, keepdims=True)
+    return np.concatenate([vectors, scalars], axis=-1)
+
+def invert_quats(quats):
+    return np.concatenate([-quats[..., :3], quats[..., 3:]], axis=-1)
+
+def rotate_points(quats, points):
+    vectors, scalars = quats[..., :3], quats[..., 3:]
+    cross = np.cross(vectors, points)
+    return points + 2*scalars*cross + 2*np.cross(vectors, cross)
+
+def multiply_poses(*arrays):
+    # Vectorized equivalent of pybullet_tools.utils.multiply
+    result = np.asarray(arrays[0], dtype=float)
+    for array in arrays[1:]:
+        array = np.asarray(array, dtype=float)
+        points = result[..., :3] + rotate_points(result[..., 3:], array[..., :3])
+        quats = multiply_quats(result[..., 3:], array[..., 3:])
+        result = np.concatenate([points, quats], axis=-1)
+    return result
+
+def invert_poses(array):
+    # Vectorized equivalent of pybullet_tools.utils.invert
+    array = np.asarray(array, dtype=float)
+    quats = invert_quats(array[..., 3:])
+    points = -rotate_points(quats, array[..., :3])
+    return np.concatenate([points, quats], axis=-1)
+
+def yaws_from_quats(quats):
+    x, y, z, w = np.moveaxis(quats, -1, 0)
+    return np.arctan2(2*(w*z + x*y), 1 - 2*(y*y + z*z))
+
+def project_base_poses(array):
+    # Vectorized equivalent of src.database.project_base_pose
+    array = np.asarray(array, dtype=float)
+    return np.concatenate([array[..., :2], yaws_from_quats(array[..., 3:])[..., np.newaxis]], axis=-1)
@@ -0,0 +1,110 @@
+from collections import OrderedDict
+
+import numpy as np
+
+from pybullet_tools.utils import get_pose, get_configuration, get_aabb, get_bodies, batch_ray_collision
+
+# Memoizes ray casts from the (fixed) cameras against the mostly static kitchen
+# Each ray is keyed by its endpoints, the kitchen joints, and the configurations of the non-static bodies
+# (robot, gripper, objects, ...) whose AABBs it intersects, which are the only bodies that can affect its result
+# Moving a body only changes the keys of the rays that pass near it, so cached results are never stale
+
+CACHE_RAYS = True
+RAY_RESOLUTION = 1e-3 # meters (and radians for joints)
+MAX_RAYS = 100000 # The least recently used rays are evicted
+
+def discretize(values, resolution=RAY_RESOLUTION):
+    return tuple(np.round(np.array(values, dtype=float).flatten() / resolution).astype(int))
+
+def discretize_pose(pose, resolution=RAY_RESOLUTION):
+    return discretize(np.concatenate(pose), resolution=resolution)
+
+def get_segment_aabb_intersections(starts, ends, lowers, uppers):
+    # (R, B) whether each segment intersects each AABB (slab method)
+    starts, ends = np.array(starts, dtype=float).reshape(-1, 3), np.array(ends, dtype=float).reshape(-1, 3)
+    lowers, uppers = np.array(lowers, dtype=float).reshape(-1, 3), np.array(uppers, dtype=float).reshape(-1, 3)
+    directions = (ends - starts)[:, np.newaxis, :]
+    offsets_lower = lowers[np.newaxis, :, :] - starts[:, np.newaxis, :]
+    offsets_upper = uppers[np.newaxis, :, :] - starts[:, np.newaxis, :]
+    parallel = (directions == 0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t1 = np.where(parallel, -np.inf, offsets_lower / directions)
+        t2 = np.where(parallel, +np.inf, offsets_upper / directions)
+    # Segments parallel to a slab intersect it everywhere or nowhere
+    outside = parallel & ((0 < offsets_lower) | (offsets_upper < 0))
+    enter = np.max(np.where(outside, np.inf, np.minimum(t1, t2)), axis=2)
+    exit = np.min(np.where(outside, -np.inf, np.maximum(t1, t2)), axis=2)
+    return (np.maximum(enter, 0.) <= np.minimum(exit, 1.))
+
+class RayCache(object):
+    def __init__(self, world, resolution=RAY_RESOLUTION, max_rays=MAX_RAYS):
+        self.world = world
+        self.resolution = resolution
+        self.max_rays = max_rays
+        self.results = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+    def get_static_bodies(self):
+        # The kitchen is keyed by its joints, and the camera cones do not collide
+        world = self.world
+        return {world.kitchen, world.floor} | set(world.environment_bodies.values()) | \
+               {camera.body for camera in world.cameras.values()}
+    def get_body_states(self):
+        # (body, AABB, discretized pose and configuration) for every other body (e.g. the floating gripper)
+        static_bodies = self.get_static_bodies()
+        return [(body, get_aabb(body), (discretize_pose(get_pose(body), self.resolution),
+                                        discretize(get_configuration(body), self.resolution)))
+                for body in get_bodies() if body not in static_bodies]
+    def get_keys(self, rays):
+        if not rays:
+            return []
+        kitchen_key = discretize(get_configuration(self.world.kitchen), self.resolution)
+        states = self.get_body_states()
+        # Grown by the resolution as the rays are rounded
+        lowers = [np.array(aabb[0]) - self.resolution for _, aabb, _ in states]
+        uppers = [np.array(aabb[1]) + self.resolution for _, aabb, _ in states]
+        intersections = get_segment_aabb_intersections([ray.start for ray in rays], [ray.end for ray in rays],
+                                                       lowers, uppers)
+        return [(discretize(ray.start, self.resolution), discretize(ray.end, self.resolution), kitchen_key,
+                 tuple((states[index][0], states[index][2]) for index in np.nonzero(intersecting)[0]))
+                for ray, intersecting in zip(rays, intersections)]
+    def ray_collision(self, rays):
+        # Same interface as batch_ray_collision; missing rays are still cast in a single batch
+        keys = self.get_keys(rays)
+        missing = OrderedDict()
+        for key, ray in zip(keys, rays):
+            if key in self.results:
+                self.results[key] = self.results.pop(key) # Marks as most recently used
+            else:
+                missing.setdefault(key, ray)
+        self.hits += len(keys) - len(missing)
+        self.misses += len(missing)
+        if missing:
+            self.results.update(zip(missing, batch_ray_collision(list(missing.values()))))
+        results = [self.results[key] for key in keys]
+        while self.max_rays < len(self.results):
+            self.results.popitem(last=False)
+        return results
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        if total == 0:
+            return 0.
+        return float(self.hits) / total
+    def clear(self):
+        self.results.clear()
+    def __repr__(self):
+        return '{}(rays={}, hits={}, misses={}, rate={:.3f})'.format(
+            self.__class__.__name__, len(self.results), self.hits, self.misses, self.hit_rate)
+
+CACHES = {}
+
+def get_ray_cache(world):
+    if id(world) not in CACHES:
+        CACHES[id(world)] = RayCache(world)
+    return CACHES[id(world)]
+
+def get_ray_collision_fn(world):
+    if not CACHE_RAYS:
+        return batch_ray_collision
+    return get_ray_cache(world).ray_collision
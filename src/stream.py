@@ -10,20 +10,21 @@ from pybullet_tools.utils import pairwise_collision, multiply, invert, get_joint
     get_custom_limits, all_between, link_from_name, get_link_pose, \
     Euler, quat_from_euler, set_pose, point_from_pose, sample_placement_on_aabb, get_sample_fn, get_pose, \
     stable_z_on_aabb, euler_from_quat, quat_from_pose, Ray, get_distance_fn, Point, set_configuration, \
-    is_point_in_polygon, grow_polygon, Pose, get_moving_links, get_aabb_extent, get_aabb_center, \
+    Pose, get_moving_links, get_aabb_extent, get_aabb_center, \
     INF, apply_affine, get_joint_name, get_unit_vector, get_link_subtree, get_link_name, unit_quat, joint_from_name, \
     get_extend_fn, wait_for_user, set_renderer, child_link_from_joint, unit_from_theta
 from pddlstream.algorithms.downward import MAX_FD_COST #, get_cost_scale
 
 from src.command import Sequence, State, Detect, DoorTrajectory
-from src.database import load_placements, get_surface_reference_pose, load_pull_base_poses, load_forward_placements, load_inverse_placements
+from src.database import load_placements, get_surface_reference_pose, \
+    get_forward_grids, get_inverse_grids, get_joint_grids, get_joint_reference_pose, GROW_INVERSE_BASE, GROW_FORWARD_RADIUS, RANDOM_ORDER
 from src.utils import get_grasps, iterate_approach_path, ALL_SURFACES, \
     get_descendant_obstacles, surface_from_name, RelPose, compute_surface_aabb, create_relative_pose, Z_EPSILON, \
     get_surface_obstacles, test_supported, \
     get_link_obstacles, ENV_SURFACES, FConf, open_surface_joints, DRAWERS, STOVES, \
     TOP_GRASP, KNOBS, APPROACH_DISTANCE, FINGER_EXTENT, set_tool_pose, translate_linearly
-from src.visualization import GROW_INVERSE_BASE, GROW_FORWARD_RADIUS
 from src.inference import SurfaceDist
+from src.visibility import get_camera_views, get_visible_mask
 from examples.discrete_belief.run import revisit_mdp_cost, clip_cost, DDist #, MAX_COST
 
 COST_SCALE = 1 # costs will always be greater than one
@@ -54,6 +55,7 @@ FIXED_FAILURES = INF # 5
 REVERSE_DISTANCE = 0.1
 
 DOOR_PROXIMITY = True
+BASE_ORDER = RANDOM_ORDER # RANDOM_ORDER | RANKED_ORDER | SUCCESS_ORDER
 
 # TODO: TracIK might not be deterministic in which case it might make sense to try a few
 # http://docs.ros.org/kinetic/api/moveit_tutorials/html/doc/trac_ik/trac_ik_tutorial.html
@@ -87,7 +89,10 @@ def compute_detect_cost(prob):
 def detect_cost_fn(obj_name, rp_dist, obs, rp_sample):
     # TODO: extend to continuous rp_sample controls using densities
     # TODO: count samples in a nearby vicinity to be invariant to number of samples
-    prob = 1. if rp_dist == rp_sample else rp_dist.discrete_prob(rp_sample)
+    if rp_dist == rp_sample:
+        prob = 1.
+    else:
+        [prob] = rp_dist.discrete_probs([rp_sample])
     cost = clip_cost(compute_detect_cost(prob), max_cost=MAX_COST)
     #print('{}) Detect Prob: {:.3f} | Detect Cost: {:.3f}'.format(
     #    rp_dist.surface_name, prob, cost))
@@ -131,14 +136,11 @@ def get_compute_angle_kin(world):
 
 ################################################################################
 
-def is_visible_by_camera(world, point):
-    for camera_name in world.cameras:
-        camera_body, camera_matrix, camera_depth = world.cameras[camera_name]
-        camera_pose = get_pose(camera_body)
-        #camera_point = point_from_pose(camera_pose)
-        if is_visible_point(camera_matrix, camera_depth, point, camera_pose):
-            return True
-    return False
+def is_visible_by_camera(world, point, views=None):
+    if views is None:
+        views = get_camera_views(world)
+    [visible] = get_visible_mask([point], views)
+    return visible
 
 def get_compute_detect(world, ray_trace=True, **kwargs):
     obstacles = world.static_obstacles
@@ -249,24 +251,41 @@ def get_sample_belief_gen(world, # min_prob=1. / NUM_PARTICLES,  # TODO: relativ
                           mlo_only=False, ordered=False, **kwargs):
     # TODO: incorporate ray tracing
     detect_fn = get_compute_detect(world, ray_trace=False, **kwargs)
+    samples_from_dist = {} # The cameras are static, so the detectable samples only depend on the distribution
+
+    def get_valid_samples(obj_name, pose_dist):
+        key = (obj_name, pose_dist)
+        if key not in samples_from_dist:
+            particles = pose_dist.particles
+            [indices] = np.nonzero((particles.get_observations() < 1) & (0 < particles.weights))
+            poses = particles.get_poses(indices)
+            probs = pose_dist.discrete_probs(poses)
+            #costs = [detect_cost_fn(obj_name, pose_dist, obs=None, rp_sample=rp) for rp in poses]
+            # pose = rp.get_world_from_body()
+            samples = {rp: prob for rp, prob in zip(poses, probs)
+                       if detect_fn(obj_name, rp) is not None}
+            # detect_fn opens the joints of each support and assigns each pose
+            supports = []
+            for rp in poses:
+                if rp.support not in supports:
+                    supports.append(rp.support)
+            samples_from_dist[key] = (samples, supports, poses[-1] if poses else None)
+        else:
+            # Reapplies the side effects of detect_fn so that repeated queries see the same kitchen configuration
+            _, supports, last_pose = samples_from_dist[key]
+            for support in supports:
+                open_surface_joints(world, support)
+            if last_pose is not None:
+                last_pose.assign()
+        samples, _, _ = samples_from_dist[key]
+        return dict(samples)
+
     def gen(obj_name, pose_dist, surface_name):
         # TODO: apply these checks to the whole surfaces
         if isinstance(pose_dist, RelPose):
             yield (pose_dist,)
             return
-        valid_samples = {}
-        for rp in pose_dist.dist.support():
-            if 1 <= rp.observations:
-                continue
-            prob = pose_dist.discrete_prob(rp)
-            #cost = detect_cost_fn(obj_name, pose_dist, obs=None, rp_sample=rp)
-            #if (cost < MAX_COST): # and (min_prob < prob):
-            # pose = rp.get_world_from_body()
-            result = detect_fn(obj_name, rp)
-            if result is not None:
-                # detect, = result
-                # detect.draw()
-                valid_samples[rp] = prob
+        valid_samples = get_valid_samples(obj_name, pose_dist)
         if not valid_samples:
             return
 
@@ -299,17 +318,17 @@ def update_belief_fn(world, **kwargs):
 ################################################################################
 
 def get_test_near_pose(world, grow_entity=GROW_FORWARD_RADIUS, collisions=False, teleport=False, **kwargs):
-    base_from_objects = grow_polygon(map(point_from_pose, load_forward_placements(world, **kwargs)), radius=grow_entity)
-    vertices_from_surface = {}
+    # Reachability polygons are precomputed per database and rasterized into occupancy grids
+    forward_grids = get_forward_grids(world, radius=grow_entity, **kwargs)
+    grids_from_surface = {}
     # TODO: alternatively, distance to hull
 
     def test(object_name, pose, base_conf):
         if object_name in ALL_SURFACES:
             surface_name = object_name
-            if surface_name not in vertices_from_surface:
-                vertices_from_surface[surface_name] = grow_polygon(
-                    map(point_from_pose, load_inverse_placements(world, surface_name)), radius=GROW_INVERSE_BASE)
-            if not vertices_from_surface[surface_name]:
+            if surface_name not in grids_from_surface:
+                grids_from_surface[surface_name] = get_inverse_grids(world, surface_name)
+            if not grids_from_surface[surface_name]:
                 return False
             base_conf.assign()
             pose.assign()
@@ -323,34 +342,39 @@ def get_test_near_pose(world, grow_entity=GROW_FORWARD_RADIUS, collisions=False,
             #    points = [Point(x, y, 0) for x, y, in vertices_from_surface[surface_name]]
             #    add_segments(points, closed=True)
             #    wait_for_user()
-            return is_point_in_polygon(point_from_pose(surface_from_base), vertices_from_surface[surface_name])
+            base_point = point_from_pose(surface_from_base)
+            return any(grid.contains(base_point) for grid in grids_from_surface[surface_name])
         else:
-            if not base_from_objects:
+            if not forward_grids:
                 return False
             base_conf.assign()
             pose.assign()
             world_from_base = get_link_pose(world.robot, world.base_link)
             world_from_object = pose.get_world_from_body()
             base_from_object = multiply(invert(world_from_base), world_from_object)
-            return is_point_in_polygon(point_from_pose(base_from_object), base_from_objects)
+            object_point = point_from_pose(base_from_object)
+            return any(grid.contains(object_point) for grid in forward_grids)
     return test
 
 def get_test_near_joint(world, **kwargs):
-    vertices_from_joint = {}
+    # Base positions are tested in the joint reference frame, where the database polygons are rasterized
+    grids_from_joint = {}
+    joint_from_worlds = {}
 
     def test(joint_name, base_conf):
         if not DOOR_PROXIMITY:
             return True
-        if joint_name not in vertices_from_joint:
-            base_confs = list(load_pull_base_poses(world, joint_name))
-            vertices_from_joint[joint_name] = grow_polygon(base_confs, radius=GROW_INVERSE_BASE)
-        if not vertices_from_joint[joint_name]:
+        if joint_name not in grids_from_joint:
+            grids_from_joint[joint_name] = get_joint_grids(world, joint_name, radius=GROW_INVERSE_BASE)
+            joint_from_worlds[joint_name] = invert(get_joint_reference_pose(world.kitchen, joint_name))
+        if not grids_from_joint[joint_name]:
             return False
         # TODO: can't open hitman_drawer_top_joint any more
         # Likely due to conservative carter geometry
         base_conf.assign()
-        base_point = point_from_pose(get_link_pose(world.robot, world.base_link))
-        return is_point_in_polygon(base_point[:2], vertices_from_joint[joint_name])
+        joint_from_base = multiply(joint_from_worlds[joint_name], get_link_pose(world.robot, world.base_link))
+        base_point = point_from_pose(joint_from_base)
+        return any(grid.contains(base_point) for grid in grids_from_joint[joint_name])
     return test
 
 ################################################################################
@@ -369,6 +393,7 @@ def get_stable_gen(world, max_attempts=100,
             surface_body = world.environment_bodies[surface_name]
         surface_aabb = compute_surface_aabb(world, surface_name)
         learned_poses = load_placements(world, surface_name) if learned else [] # TODO: GROW_PLACEMENT
+        views = get_camera_views(world) # The cameras are static
 
         yaw_range = (-np.pi, np.pi)
         #if world.is_real():
@@ -406,7 +431,7 @@ def get_stable_gen(world, max_attempts=100,
                                                                epsilon=z_offset, percent=2.0)
                     if body_pose_world is None:
                         continue # return?
-                if visibility and not is_visible_by_camera(world, point_from_pose(body_pose_world)):
+                if visibility and not is_visible_by_camera(world, point_from_pose(body_pose_world), views=views):
                     continue
                 # TODO: make sure the surface is open when doing this
 
@@ -462,20 +487,11 @@ def get_grasp_gen(world, collisions=False, randomize=True, **kwargs): # teleport
 ################################################################################
 
 def is_robot_visible(world, links):
-    for link in links:
-        link_point = point_from_pose(get_link_pose(world.robot, link))
-        visible = False
-        for camera_body, camera_matrix, camera_depth in world.cameras.values():
-            camera_pose = get_pose(camera_body)
-            #camera_point = point_from_pose(camera_pose)
-            #add_line(link_point, camera_point)
-            if is_visible_point(camera_matrix, camera_depth, link_point, camera_pose):
-                visible = True
-                break
-        if not visible:
-            return False
-    #wait_for_user()
-    return True
+    if not links:
+        return True
+    link_points = [point_from_pose(get_link_pose(world.robot, link)) for link in links]
+    #add_line(link_point, camera_point)
+    return np.all(get_visible_mask(link_points, get_camera_views(world)))
 
 def test_base_conf(world, bq, obstacles, min_distance=0.0):
     robot_links = [world.franka_link, world.gripper_link] if world.is_real() else []
@@ -489,7 +505,8 @@ def test_base_conf(world, bq, obstacles, min_distance=0.0):
     return True
 
 def inverse_reachability(world, base_generator, obstacles=set(),
-                         max_attempts=25, **kwargs):
+                         max_attempts=25, avoid=None, **kwargs):
+    # Rejected base confs are appended to avoid so that ranked generators can penalize them
     min_distance = 0.01 #if world.is_real() else 0.0
     min_nearby_distance = 0.1 # if world.is_real() else 0.0
     lower_limits, upper_limits = get_custom_limits(
@@ -503,6 +520,8 @@ def inverse_reachability(world, base_generator, obstacles=set(),
             bq = FConf(world.robot, world.base_joints, base_conf)
             #wait_for_user()
             if not test_base_conf(world, bq, obstacles, min_distance=min_distance):
+                if avoid is not None:
+                    avoid.append(base_conf)
                 continue
             if world.is_real():
                 # TODO: could also rotate in place
@@ -4,8 +4,9 @@ from itertools import cycle
 from pybullet_tools.utils import BodySaver, get_sample_fn, set_joint_positions, multiply, invert, get_moving_links, \
     pairwise_collision, uniform_pose_generator, get_movable_joints, wait_for_user, INF
 from src.command import Sequence, State, ApproachTrajectory, Detach, AttachGripper
-from src.database import load_place_base_poses
-from src.stream import PRINT_FAILURES, plan_approach, MOVE_ARM, P_RANDOMIZE_IK, inverse_reachability, FIXED_FAILURES
+from src.database import load_place_base_poses, record_base_outcome, flush_outcomes
+from src.stream import PRINT_FAILURES, plan_approach, MOVE_ARM, P_RANDOMIZE_IK, inverse_reachability, FIXED_FAILURES, \
+    BASE_ORDER
 from src.streams.move import get_gripper_motion_gen
 from src.utils import FConf, create_surface_attachment, get_surface_obstacles, iterate_approach_path
 
@@ -115,10 +116,13 @@ def get_fixed_pick_gen_fn(world, max_attempts=25, collisions=True, **kwargs):
     return gen
 
 
-def get_pick_gen_fn(world, max_attempts=25, collisions=True, learned=True, **kwargs):
+def get_pick_gen_fn(world, max_attempts=25, collisions=True, learned=True, order=BASE_ORDER, **kwargs):
     # TODO: sample in the neighborhood of the base conf to ensure robust
+    target = world.get_base_conf() # Current base conf when the streams are constructed
 
     def gen(obj_name, pose, grasp, *args):
+        avoid = []
+        proposals = {}
         obstacles = world.static_obstacles | get_surface_obstacles(world, pose.support)
         #if not collisions:
         #    obstacles = set()
@@ -128,10 +132,13 @@ def get_pick_gen_fn(world, max_attempts=25, collisions=True, learned=True, **kwa
         # TODO: check collisions with obj at pose
         gripper_pose = multiply(pose.get_world_from_body(), invert(grasp.grasp_pose)) # w_f_g = w_f_o * (g_f_o)^-1
         if learned:
-            base_generator = cycle(load_place_base_poses(world, gripper_pose, pose.support, grasp.grasp_type))
+            base_generator = cycle(load_place_base_poses(world, gripper_pose, pose.support, grasp.grasp_type,
+                                                          order=order, target=target, avoid=avoid,
+                                                          context='pick', proposals=proposals))
         else:
             base_generator = uniform_pose_generator(world.robot, gripper_pose)
-        safe_base_generator = inverse_reachability(world, base_generator, obstacles=obstacles, **kwargs)
+        safe_base_generator = inverse_reachability(world, base_generator, obstacles=obstacles,
+                                                   avoid=avoid, **kwargs)
         while True:
             for i in range(max_attempts):
                 try:
@@ -144,11 +151,14 @@ def get_pick_gen_fn(world, max_attempts=25, collisions=True, learned=True, **kwa
                 randomize = (random.random() < P_RANDOMIZE_IK)
                 ik_outputs = next(plan_pick(world, obj_name, pose, grasp, base_conf, obstacles,
                                             randomize=randomize, **kwargs), None)
+                record_base_outcome(proposals, base_conf.values, 'pick', ik_outputs is not None)
                 if ik_outputs is not None:
                     print('Pick succeeded after {} attempts'.format(i))
+                    flush_outcomes()
                     yield (base_conf,) + ik_outputs
                     break
             else:
+                flush_outcomes()
                 if PRINT_FAILURES: print('Pick failure after {} attempts'.format(max_attempts))
                 #if not pose.init: # Might be an intended placement blocked by a drawer
                 #    break
@@ -6,9 +6,10 @@ from pybullet_tools.utils import BodySaver, get_sample_fn, set_joint_positions,
     pairwise_collision, link_from_name, get_unit_vector, unit_point, Pose, get_link_pose, \
     uniform_pose_generator, INF
 from src.command import Sequence, State, ApproachTrajectory, Wait
-from src.stream import plan_approach, MOVE_ARM, inverse_reachability, P_RANDOMIZE_IK, PRINT_FAILURES, FIXED_FAILURES
+from src.stream import plan_approach, MOVE_ARM, inverse_reachability, P_RANDOMIZE_IK, PRINT_FAILURES, FIXED_FAILURES, \
+    BASE_ORDER
 from src.utils import FConf, APPROACH_DISTANCE, TOOL_POSE, FINGER_EXTENT, Grasp, TOP_GRASP
-from src.database import load_pull_base_poses
+from src.database import load_pull_base_poses, record_base_outcome, flush_outcomes
 
 def get_grasp_presses(world, knob, pre_distance=APPROACH_DISTANCE):
     knob_link = link_from_name(world.kitchen, knob)
@@ -87,8 +88,13 @@ def get_fixed_press_gen_fn(world, max_attempts=25, collisions=True, teleport=Fal
                 max_failures += 1
     return gen
 
-def get_press_gen_fn(world, max_attempts=50, collisions=True, teleport=False, learned=True, **kwargs):
+def get_press_gen_fn(world, max_attempts=50, collisions=True, teleport=False, learned=True,
+                     order=BASE_ORDER, **kwargs):
+    target = world.get_base_conf() # Current base conf when the streams are constructed
+
     def gen(knob_name):
+        avoid = []
+        proposals = {}
         obstacles = world.static_obstacles
         knob_link = link_from_name(world.kitchen, knob_name)
         pose = get_link_pose(world.kitchen, knob_link)
@@ -97,10 +103,12 @@ def get_press_gen_fn(world, max_attempts=50, collisions=True, teleport=False, le
         grasp = next(presses)
         gripper_pose = multiply(pose, invert(grasp.grasp_pose)) # w_f_g = w_f_o * (g_f_o)^-1
         if learned:
-            base_generator = cycle(load_pull_base_poses(world, knob_name))
+            base_generator = cycle(load_pull_base_poses(world, knob_name, order=order, target=target, avoid=avoid,
+                                                        context='press', proposals=proposals))
         else:
             base_generator = uniform_pose_generator(world.robot, gripper_pose)
-        safe_base_generator = inverse_reachability(world, base_generator, obstacles=obstacles, **kwargs)
+        safe_base_generator = inverse_reachability(world, base_generator, obstacles=obstacles,
+                                                   avoid=avoid, **kwargs)
         while True:
             for i in range(max_attempts):
                 try:
@@ -114,11 +122,14 @@ def get_press_gen_fn(world, max_attempts=50, collisions=True, teleport=False, le
                 randomize = (random.random() < P_RANDOMIZE_IK)
                 ik_outputs = next(plan_press(world, knob_name, pose, grasp, base_conf, obstacles,
                                              randomize=randomize, **kwargs), None)
+                record_base_outcome(proposals, base_conf.values, 'press', ik_outputs is not None)
                 if ik_outputs is not None:
                     print('Press succeeded after {} attempts'.format(i))
+                    flush_outcomes()
                     yield (base_conf,) + ik_outputs
                     break
             else:
+                flush_outcomes()
                 if PRINT_FAILURES: print('Press failure after {} attempts'.format(max_attempts))
                 #if not pose.init:
                 #    break
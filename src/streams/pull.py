@@ -5,9 +5,9 @@ from pybullet_tools.pr2_utils import close_until_collision
 from pybullet_tools.utils import multiply, joint_from_name, set_joint_positions, invert, \
     pairwise_collision, BodySaver, uniform_pose_generator, INF
 from src.command import ApproachTrajectory, DoorTrajectory, Sequence, State
-from src.database import load_pull_base_poses
+from src.database import load_pull_base_poses, record_base_outcome, flush_outcomes
 from src.stream import PRINT_FAILURES, plan_workspace, plan_approach, MOVE_ARM, \
-    P_RANDOMIZE_IK, inverse_reachability, compute_door_paths, FIXED_FAILURES
+    P_RANDOMIZE_IK, inverse_reachability, compute_door_paths, FIXED_FAILURES, BASE_ORDER
 from src.streams.move import get_gripper_motion_gen
 from src.utils import get_descendant_obstacles, FConf
 
@@ -126,9 +126,11 @@ def get_fixed_pull_gen_fn(world, max_attempts=25, collisions=True, teleport=Fals
     return gen
 
 
-def get_pull_gen_fn(world, max_attempts=50, collisions=True, teleport=False, learned=True, **kwargs):
+def get_pull_gen_fn(world, max_attempts=50, collisions=True, teleport=False, learned=True,
+                    order=BASE_ORDER, **kwargs):
     # TODO: could condition pick/place into cabinet on the joint angle
     obstacles = world.static_obstacles
+    target = world.get_base_conf() # Current base conf when the streams are constructed
     #if not collisions:
     #    obstacles = set()
 
@@ -139,14 +141,18 @@ def get_pull_gen_fn(world, max_attempts=50, collisions=True, teleport=False, lea
         door_paths = compute_door_paths(world, joint_name, door_conf1, door_conf2, obstacles, teleport=teleport)
         if not door_paths:
             return
+        avoid = []
+        proposals = {}
         if learned:
-            base_generator = cycle(load_pull_base_poses(world, joint_name))
+            base_generator = cycle(load_pull_base_poses(world, joint_name, order=order, target=target, avoid=avoid,
+                                                        context='pull', proposals=proposals))
         else:
             _, _, _, tool_path = door_paths[0]
             index = int(len(tool_path) / 2)  # index = 0
             target_pose = tool_path[index]
             base_generator = uniform_pose_generator(world.robot, target_pose)
-        safe_base_generator = inverse_reachability(world, base_generator, obstacles=obstacles, **kwargs)
+        safe_base_generator = inverse_reachability(world, base_generator, obstacles=obstacles,
+                                                   avoid=avoid, **kwargs)
         while True:
             for i in range(max_attempts):
                 try:
@@ -160,11 +166,14 @@ def get_pull_gen_fn(world, max_attempts=50, collisions=True, teleport=False, lea
                 randomize = (random.random() < P_RANDOMIZE_IK)
                 ik_outputs = next(plan_pull(world, door_joint, door_path, base_conf,
                                             randomize=randomize, collisions=collisions, teleport=teleport, **kwargs), None)
+                record_base_outcome(proposals, base_conf.values, 'pull', ik_outputs is not None)
                 if ik_outputs is not None:
                     print('Pull succeeded after {} attempts'.format(i))
+                    flush_outcomes()
                     yield (base_conf,) + ik_outputs
                     break
             else:
+                flush_outcomes()
                 if PRINT_FAILURES: print('Pull failure')
                 yield None
     return gen
\ No newline at end of file
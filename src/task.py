@@ -5,8 +5,8 @@ import random
 import time
 
 from pybullet_tools.utils import set_pose, Pose, Point, Euler, multiply, get_pose, \
-    create_box, set_all_static, WorldSaver, create_plane, COLOR_FROM_NAME, \
-    stable_z_on_aabb, pairwise_collision, elapsed_time, get_aabb_extent, get_aabb, create_cylinder, set_point, \
+    set_all_static, WorldSaver, create_plane, COLOR_FROM_NAME, \
+    stable_z_on_aabb, pairwise_collision, elapsed_time, get_aabb_extent, get_aabb, set_point, \
     get_function_name, wait_for_user
 from src.stream import get_stable_gen, MAX_COST
 from src.utils import JOINT_TEMPLATE, BLOCK_SIZES, BLOCK_COLORS, COUNTERS, \
@@ -90,8 +90,8 @@ def add_block(world, idx=0, **kwargs):
     #world.add_body(name)
     #print(get_aabb_extent(get_aabb(world.get_body(name))))
     side = BIG_BLOCK_SIDE
-    body = create_box(w=side, l=side, h=side, color=COLOR_FROM_NAME[color])
-    world.add(name, body)
+    geometry = ('box', {'w': side, 'l': side, 'h': side, 'color': COLOR_FROM_NAME[color]})
+    world.add_geometry(name, geometry)
     pose2d_on_surface(world, name, COUNTERS[0], **kwargs)
     return name
 
@@ -107,15 +107,15 @@ add_cracker_box = lambda world, **kwargs: add_ycb(world, 'cracker_box', **kwargs
 def add_box(world, color_name, idx=0, **kwargs):
     name = name_from_type(color_name, idx)
     # TODO: geometry type
-    body = create_box(w=0.07, l=0.07, h=0.14, color=COLOR_FROM_NAME[color_name])
-    world.add(name, body)
+    geometry = ('box', {'w': 0.07, 'l': 0.07, 'h': 0.14, 'color': COLOR_FROM_NAME[color_name]})
+    world.add_geometry(name, geometry)
     # pose2d_on_surface(world, name, COUNTERS[0], **kwargs)
     return name
 
 def add_cylinder(world, color_name, idx=0, **kwargs):
     name = name_from_type(color_name, idx)
-    body = create_cylinder(radius=0.07/2, height=0.14, color=COLOR_FROM_NAME[color_name])
-    world.add(name, body)
+    geometry = ('cylinder', {'radius': 0.07/2, 'height': 0.14, 'color': COLOR_FROM_NAME[color_name]})
+    world.add_geometry(name, geometry)
     # pose2d_on_surface(world, name, COUNTERS[0], **kwargs)
     return name
 
@@ -0,0 +1,70 @@
+import numpy as np
+
+from collections import namedtuple
+
+from pybullet_tools.utils import get_pose, Ray, batch_ray_collision
+from src.poses import array_from_pose, invert_poses, rotate_points
+
+CameraView = namedtuple('CameraView', ['pose', 'matrix', 'depth'])
+
+def get_camera_views(world, camera_names=None):
+    if camera_names is None:
+        camera_names = sorted(world.cameras)
+    return [CameraView(get_pose(world.cameras[name].body), world.cameras[name].matrix, world.cameras[name].depth)
+            for name in camera_names]
+
+def get_visible_masks(points, views):
+    # (C, N) vectorized pybullet_tools.pr2_utils.is_visible_point for each camera view
+    points = np.array(points, dtype=float).reshape(-1, 3)
+    masks = np.zeros((len(views), len(points)), dtype=bool)
+    for i, view in enumerate(views):
+        camera_from_world = invert_poses(array_from_pose(view.pose))
+        points_camera = camera_from_world[:3] + rotate_points(camera_from_world[3:], points)
+        depths = points_camera[:, 2]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            rays = points_camera / depths[:, np.newaxis]
+        pixels = rays.dot(np.array(view.matrix, dtype=float).T)[:, :2]
+        cx, cy = np.array(view.matrix, dtype=float)[:2, 2]
+        width, height = (2*cx + 1), (2*cy + 1)
+        masks[i] = (0 < depths) & (depths <= view.depth) & \
+                   (0 <= pixels[:, 0]) & (pixels[:, 0] < width) & \
+                   (0 <= pixels[:, 1]) & (pixels[:, 1] < height)
+    return masks
+
+def get_visible_mask(points, views):
+    # Whether each point is visible by any of the camera views
+    return np.any(get_visible_masks(points, views), axis=0)
+
+################################################################################
+
+def get_camera_rays(camera_points, points, masks):
+    # A ray from each camera to each point within its frustum
+    rays = []
+    owners = []
+    for camera_point, mask in zip(camera_points, masks):
+        for index in np.nonzero(mask)[0]:
+            rays.append(Ray(camera_point, points[index]))
+            owners.append(index)
+    return rays, np.array(owners, dtype=int)
+
+def compute_occlusion_masks(queries, camera_points, ray_collision_fn=batch_ray_collision, transparent=set()):
+    # Each query is (body, points, masks) where masks[c, i] is whether points[i] is within camera c's frustum
+    # The rays for all queries and cameras are cast in a single batch
+    # A point is visible when any of its rays first hits the query's body, a transparent body, or nothing
+    all_rays = []
+    ray_owners = []
+    for body, points, masks in queries:
+        rays, owners = get_camera_rays(camera_points, points, masks)
+        all_rays.extend(rays)
+        ray_owners.append(owners)
+    results = ray_collision_fn(all_rays) if all_rays else []
+    visible_masks = []
+    start = 0
+    for (body, points, _), owners in zip(queries, ray_owners):
+        hits = np.array([(result.objectUniqueId in (body, -1)) or (result.objectUniqueId in transparent)
+                         for result in results[start:start + len(owners)]], dtype=bool)
+        visible = np.zeros(len(points), dtype=bool)
+        visible[owners[hits]] = True
+        visible_masks.append(visible)
+        start += len(owners)
+    return visible_masks
@@ -3,12 +3,9 @@ import numpy as np
 from pybullet_tools.utils import get_point, convex_hull, Point, add_segments, convex_centroid, add_text, spaced_colors, \
     multiply, point_from_pose, get_pose, invert, link_from_name, grow_polygon, GREEN, get_link_pose
 from src.database import load_pull_base_poses, get_surface_reference_pose, load_placements, \
-    load_place_base_poses, load_forward_placements, load_inverse_placements
+    load_place_base_poses, load_forward_placements, load_inverse_placements, GROW_INVERSE_BASE, GROW_FORWARD_RADIUS
 from src.utils import ALL_JOINTS, ALL_SURFACES, get_grasps, surface_from_name, STOVES
 
-GROW_INVERSE_BASE = 0.05 # 0.05 | 0.1
-GROW_FORWARD_RADIUS = 0.25 # Done for block. Incorrect for other object types
-
 def get_floor_z(world, floor_z=0.005):
     return get_point(world.floor)[2] + floor_z
 
@@ -0,0 +1,143 @@
+from __future__ import print_function
+
+import random
+import os
+import traceback
+import numpy as np
+
+from multiprocessing import Pool, Queue, cpu_count
+try:
+    from Queue import Empty
+except ImportError:
+    from queue import Empty
+
+from pybullet_tools.utils import get_pose, set_pose, get_configuration, set_configuration, get_aabb, LockRenderer
+from src.raycache import get_ray_collision_fn
+from src.visibility import compute_occlusion_masks
+
+# Worker processes that each own a DIRECT-mode copy of the world
+# Tasks carry the world state (joint positions and body poses) that they depend on
+
+WORKER = {}
+WORKER_TIMEOUT = 5*60 # seconds for every worker to create its world
+
+def get_world_config(world):
+    missing = sorted(set(world.body_from_name) - set(world.geometry_from_name))
+    if missing:
+        raise ValueError('Bodies {} were not added with a geometry and cannot be recreated in worker worlds'.format(
+            missing))
+    return {
+        'robot_name': world.robot_name,
+        'full_kitchen': bool(world.environment_bodies),
+        'geometries': sorted(world.geometry_from_name.items()),
+        'cameras': {name: (get_pose(camera.body), np.array(camera.matrix).tolist(), camera.depth)
+                    for name, camera in world.cameras.items()},
+    }
+
+def get_world_state(world):
+    return {
+        'kitchen': get_configuration(world.kitchen),
+        'robot': (get_pose(world.robot), get_configuration(world.robot)),
+        'bodies': {name: get_pose(body) for name, body in world.body_from_name.items()},
+    }
+
+def set_world_state(world, state):
+    set_configuration(world.kitchen, state['kitchen'])
+    robot_pose, robot_conf = state['robot']
+    set_pose(world.robot, robot_pose)
+    set_configuration(world.robot, robot_conf)
+    for name, pose in state['bodies'].items():
+        set_pose(world.get_body(name), pose)
+
+def get_body_aabbs(world):
+    return {name: np.array(get_aabb(body)) for name, body in world.body_from_name.items()}
+
+def check_body_aabbs(expected_aabbs, aabbs, tolerance=1e-3):
+    # Bodies in the same state should have the same names and AABBs
+    if set(expected_aabbs) != set(aabbs):
+        raise RuntimeError('Worker world bodies {} do not match bodies {}'.format(
+            sorted(aabbs), sorted(expected_aabbs)))
+    mismatched = sorted(name for name in expected_aabbs
+                        if not np.allclose(expected_aabbs[name], aabbs[name], atol=tolerance))
+    if mismatched:
+        raise RuntimeError('Worker world bodies {} do not match their shapes'.format(mismatched))
+
+def create_worker_world(config):
+    from src.world import World
+    world = World(robot_name=config['robot_name'], use_gui=False, full_kitchen=config['full_kitchen'])
+    for name, geometry in config['geometries']:
+        world.add_geometry(name, geometry)
+    for name, (pose, camera_matrix, depth) in config['cameras'].items():
+        world.add_camera(name, pose, np.array(camera_matrix), max_depth=depth)
+    return world
+
+def initialize_worker(config, state, reports):
+    # Each worker reports (pid, AABBs, error) exactly once
+    # Exceptions are not raised because Pool endlessly respawns workers whose initializer fails
+    random.seed()
+    np.random.seed()
+    try:
+        with LockRenderer():
+            world = create_worker_world(config)
+            set_world_state(world, state)
+        WORKER['world'] = world
+        reports.put((os.getpid(), get_body_aabbs(world), None))
+    except Exception:
+        reports.put((os.getpid(), None, traceback.format_exc()))
+
+################################################################################
+
+def compute_visible_masks(task):
+    # Ray traces the queries (name, points, frustum masks) from every camera in a single batch
+    state, camera_points, queries = task
+    world = WORKER['world']
+    set_world_state(world, state)
+    return compute_occlusion_masks([(world.get_body(name), points, masks) for name, points, masks in queries],
+                                   camera_points, ray_collision_fn=get_ray_collision_fn(world))
+
+class WorldPool(object):
+    def __init__(self, world, processes=0):
+        self.config = get_world_config(world)
+        self.processes = processes if 0 < processes else cpu_count()
+        reports = Queue()
+        self.pool = Pool(processes=self.processes, initializer=initialize_worker,
+                         initargs=(self.config, get_world_state(world), reports))
+        try:
+            self.check(world, reports)
+        except RuntimeError:
+            self.close()
+            raise
+    def check(self, world, reports, timeout=WORKER_TIMEOUT):
+        # Raises an error unless every worker recreated the world with the same bodies
+        expected_aabbs = get_body_aabbs(world)
+        for _ in range(self.processes):
+            try:
+                pid, aabbs, error = reports.get(timeout=timeout)
+            except Empty:
+                raise RuntimeError('Worker worlds were not created within {} seconds'.format(timeout))
+            if error is not None:
+                raise RuntimeError('Worker {} failed to create its world:\n{}'.format(pid, error))
+            check_body_aabbs(expected_aabbs, aabbs)
+    def is_compatible(self, world):
+        return self.config == get_world_config(world)
+    def map(self, fn, tasks):
+        # Results are returned in the order of the tasks
+        return self.pool.map(fn, tasks)
+    def close(self):
+        self.pool.terminate()
+        self.pool.join()
+    def __repr__(self):
+        return '{}({})'.format(self.__class__.__name__, self.processes)
+
+POOLS = {}
+
+def get_world_pool(world, processes=0):
+    # Recreates the pool if bodies or cameras have been added since it was created
+    pool = POOLS.get(id(world), None)
+    if (pool is not None) and not pool.is_compatible(world):
+        pool.close()
+        pool = None
+    if pool is None:
+        pool = WorldPool(world, processes=processes)
+        POOLS[id(world)] = pool
+    return pool
@@ -17,7 +17,7 @@ from pybullet_tools.utils import connect, add_data_path, load_pybullet, HideOutp
     is_center_on_aabb, Euler, euler_from_quat, quat_from_pose, point_from_pose, get_pose, set_pose, stable_z_on_aabb, \
     set_quat, quat_from_euler, INF, read_json, set_camera_pose, set_real_time, set_caching, draw_aabb, \
     disable_gravity, set_all_static, get_movable_joints, get_joint_names, wait_for_user, reset_simulation, \
-    get_all_links, sub_inverse_kinematics, get_distance, load_yaml
+    get_all_links, sub_inverse_kinematics, get_distance, load_yaml, create_box, create_cylinder
 from pybullet_tools.ikfast.franka_panda.ik import ikfast_inverse_kinematics, PANDA_INFO, \
     closest_inverse_kinematics, is_ik_compiled
 from src.utils import FRANKA_CARTER, FRANKA_CARTER_PATH, create_gripper, \
@@ -63,6 +63,16 @@ Camera = namedtuple('Camera', ['body', 'matrix', 'depth'])
 # https://github.com/JenniferBuehler/common-sensors/tree/master/common_sensors/urdf/sensors
 KINECT_URDF = 'models/kinect/kinect.urdf'
 
+def create_geometry(geometry):
+    kind, kwargs = geometry
+    if kind == 'box':
+        return create_box(**kwargs)
+    if kind == 'cylinder':
+        return create_cylinder(**kwargs)
+    if kind == 'kinect':
+        return load_pybullet(KINECT_URDF, fixed_base=True)
+    raise ValueError(kind)
+
 ################################################################################
 
 # table distance +x: 116cm, -y: 353cm (rotated 90 degrees)
@@ -124,6 +134,7 @@ class World(object):
         self.initial_saver = WorldSaver()
 
         self.body_from_name = {}
+        self.geometry_from_name = {} # How each body was created (see create_geometry)
         # self.path_from_name = {}
         self.names_from_type = {}
         self.custom_limits = {}
@@ -476,7 +487,7 @@ class World(object):
             kinect = load_pybullet(KINECT_URDF, fixed_base=True)
             set_pose(kinect, pose)
             set_color(kinect, BLACK)
-            self.add(name, kinect)
+            self.add(name, kinect, geometry=('kinect', {}))
         self.cameras[name] = Camera(cone, camera_matrix, max_depth)
         draw_pose(pose)
         step_simulation()
@@ -532,10 +543,13 @@ class World(object):
 
     #########################
 
-    def add(self, name, body):
+    def add(self, name, body, geometry=None):
+        # geometry is a (kind, kwargs) recipe that recreates the body (required by worker worlds)
         assert name not in self.body_from_name
         add_body_name(body, name)
         self.body_from_name[name] = body
+        if geometry is not None:
+            self.geometry_from_name[name] = geometry
         return name
     def add_body(self, name, **kwargs):
         obj_type = type_from_name(name)
@@ -545,7 +559,15 @@ class World(object):
         print('Loading', path)
         body = load_pybullet(path, **kwargs)
         assert body is not None
-        self.add(name, body)
+        geometry = ('obj', {key: np.array(value).tolist() if isinstance(value, np.ndarray) else value
+                            for key, value in kwargs.items()})
+        return self.add(name, body, geometry=geometry)
+    def add_geometry(self, name, geometry):
+        # Recreates a body from the recipe recorded by add
+        kind, kwargs = geometry
+        if kind == 'obj':
+            return self.add_body(name, **kwargs)
+        return self.add(name, create_geometry(geometry), geometry=geometry)
     def get_body(self, name):
         return self.body_from_name[name]
 
@@ -561,6 +583,7 @@ class World(object):
         body = self.get_body(name)
         remove_body(body)
         del self.body_from_name[name]
+        self.geometry_from_name.pop(name, None)
     def reset(self):
         #remove_all_debug()
         for camera in self.cameras.values():
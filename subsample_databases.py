@@ -0,0 +1,54 @@
+#!/usr/bin/env python2
+
+from __future__ import print_function
+
+import argparse
+import glob
+import os
+import sys
+import time
+
+sys.path.extend(os.path.abspath(os.path.join(os.getcwd(), d))
+                for d in ['pddlstream', 'ss-pybullet'])
+
+from pybullet_tools.utils import elapsed_time, read_json, write_json, ensure_dir
+from src.database import DATABASE_DIRECTORY, compile_database, farthest_point_indices, \
+    embed_base_values, base_values_from_array
+
+# Writes coverage-preserving subsamples of the inverse-reachability databases
+# The original databases are left untouched
+
+def subsample_database(path, output_path, k):
+    data = read_json(path)
+    entries = data.get('entries', [])
+    array = compile_database(path, save=False)
+    indices = sorted(farthest_point_indices(embed_base_values(base_values_from_array(array)), k))
+    data['entries'] = [entries[index] for index in indices]
+    data['subsampled_from'] = len(entries)
+    write_json(output_path, data)
+    return data
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-k', type=int, default=250,
+                        help='The maximum number of entries to keep per database.')
+    parser.add_argument('-directory', default=DATABASE_DIRECTORY,
+                        help='The directory of databases to subsample.')
+    parser.add_argument('-output', default=os.path.join(DATABASE_DIRECTORY, 'subsampled/'),
+                        help='The directory to write the subsampled databases.')
+    args = parser.parse_args()
+    assert 1 <= args.k
+    assert os.path.abspath(args.directory) != os.path.abspath(args.output)
+
+    paths = sorted(glob.glob(os.path.join(args.directory, '*.json')))
+    print('Databases:', len(paths))
+    for path in paths:
+        start_time = time.time()
+        output_path = os.path.join(args.output, os.path.basename(path))
+        ensure_dir(output_path)
+        data = subsample_database(path, output_path, args.k)
+        print('Subsampled {} to {} entries into {} [{:.3f}]'.format(
+            data['subsampled_from'], len(data['entries']), output_path, elapsed_time(start_time)))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,45 @@
+from __future__ import print_function
+
+import sys
+import os
+
+import numpy as np
+import pytest
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
+sys.path.extend(os.path.join(ROOT, d) for d in ['', 'pddlstream', 'ss-pybullet'])
+
+pytest.importorskip('pybullet')
+
+from examples.discrete_belief.dist import DeltaDist
+from pybullet_tools.utils import get_pose, set_pose, Pose, Point, point_from_pose
+from src.particles import Particles
+from src.task import add_block
+from src.utils import create_world_pose
+from src.world import World
+
+
+@pytest.fixture
+def world():
+    world = World(use_gui=False)
+    yield world
+    world.destroy()
+
+
+def test_world_pose_particles(world):
+    # World poses (support=None) are attached to the kitchen base link rather than a surface
+    name = add_block(world, idx=0)
+    body = world.get_body(name)
+    set_pose(body, Pose(Point(1., 2., 0.5)))
+    pose = create_world_pose(world, name)
+    world_point = point_from_pose(get_pose(body))
+
+    particles = Particles.from_dist(world, name, DeltaDist(pose))
+    assert particles.surfaces == [None]
+    assert np.allclose(particles.get_world_points(), [world_point])
+
+    resampled = particles.resample(3)
+    assert np.allclose(resampled.get_world_points(), [world_point]*3)
+    for new_pose in resampled.get_poses():
+        assert (new_pose.reference_body, new_pose.reference_link) == (pose.reference_body, pose.reference_link)
+        assert np.allclose(point_from_pose(new_pose.get_world_from_body()), world_point)